@@ -0,0 +1,114 @@
+"""Measures `concat_batches`, `slice_batch` and `batch_len` on realistic
+multi-field batches: an image classification batch (a tuple of images and
+labels) and a detection-style batch (a dict holding images, nested dicts of
+targets and lists of file names).
+
+`concat_batches` is compared against concatenating each field by hand,
+which is the least work possible, and against collating the individual
+samples of the pieces all over again with `default_collate`.
+
+Run with:
+    $ python benchmarks/batch_ops_benchmark.py [--batch-size 256] [--size 128]
+"""
+
+import argparse
+import timeit
+
+import torch
+
+try:
+    from torch.utils.data.dataloader import default_collate
+except ImportError:
+    from torch.utils.data._utils.collate import default_collate
+
+from nonechucks.utils import batch_len, concat_batches, slice_batch
+
+
+def classification_samples(n, size):
+    return [(torch.randn(3, size, size), i % 10) for i in range(n)]
+
+
+def detection_samples(n, size):
+    return [
+        {
+            "image": torch.randn(3, size, size),
+            "target": {
+                "boxes": torch.rand(8, 4),
+                "labels": torch.randint(0, 80, (8,)),
+                "meta": {"area": torch.rand(8), "crowd": torch.zeros(8)},
+            },
+            "file_name": "image_{:06d}.jpg".format(i),
+        }
+        for i in range(n)
+    ]
+
+
+def concat_classification_by_hand(batches):
+    return (
+        torch.cat([batch[0] for batch in batches]),
+        torch.cat([batch[1] for batch in batches]),
+    )
+
+
+def concat_detection_by_hand(batches):
+    targets = [batch["target"] for batch in batches]
+    return {
+        "image": torch.cat([batch["image"] for batch in batches]),
+        "target": {
+            "boxes": torch.cat([t["boxes"] for t in targets]),
+            "labels": torch.cat([t["labels"] for t in targets]),
+            "meta": {
+                "area": torch.cat([t["meta"]["area"] for t in targets]),
+                "crowd": torch.cat([t["meta"]["crowd"] for t in targets]),
+            },
+        },
+        "file_name": [name for batch in batches for name in batch["file_name"]],
+    }
+
+
+def best_of(fn, repeat):
+    return min(timeit.repeat(fn, number=1, repeat=repeat)) * 1e3
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch-size", type=int, default=256)
+    parser.add_argument("--size", type=int, default=128, help="image height/width")
+    parser.add_argument("--pieces", type=int, default=4)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    piece_size = args.batch_size // args.pieces
+    workloads = [
+        ("classification", classification_samples, concat_classification_by_hand),
+        ("detection", detection_samples, concat_detection_by_hand),
+    ]
+    print("batch of {} in {} pieces".format(args.batch_size, args.pieces))
+    print(
+        "{:>16} {:>12} {:>12} {:>14} {:>10} {:>10}".format(
+            "batch", "concat ms", "by hand ms", "recollate ms", "slice us", "len us"
+        )
+    )
+    for name, make_samples, concat_by_hand in workloads:
+        samples = make_samples(piece_size * args.pieces, args.size)
+        chunks = [
+            samples[start : start + piece_size]
+            for start in range(0, len(samples), piece_size)
+        ]
+        pieces = [default_collate(chunk) for chunk in chunks]
+
+        concat = best_of(lambda: concat_batches(pieces), args.repeat)
+        by_hand = best_of(lambda: concat_by_hand(pieces), args.repeat)
+        recollate = best_of(lambda: default_collate(samples), args.repeat)
+        batch = concat_batches(pieces)
+        slice_time = best_of(lambda: slice_batch(batch, 0, piece_size), 100)
+        len_time = best_of(lambda: batch_len(batch), 100)
+        print(
+            "{:>16} {:>12.2f} {:>12.2f} {:>14.2f} {:>10.1f} {:>10.1f}".format(
+                name, concat, by_hand, recollate, slice_time * 1e3, len_time * 1e3
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
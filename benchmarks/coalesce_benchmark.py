@@ -0,0 +1,59 @@
+"""Compares the cost of assembling a full batch out of several short ones by
+repeatedly concatenating them (as `_SafeDataLoaderIter` used to do with
+`collate_batches`) against `concat_batches`, which allocates the output once
+and copies every piece into a slice of it.
+
+Run with:
+    $ python benchmarks/coalesce_benchmark.py [--batch-size 256] [--size 256]
+"""
+
+import argparse
+import timeit
+
+import torch
+
+from nonechucks.utils import concat_batches
+
+
+def concat_repeatedly(pieces):
+    batch = pieces[0]
+    for piece in pieces[1:]:
+        batch = torch.cat([batch, piece], 0)
+    return batch
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch-size", type=int, default=256)
+    parser.add_argument("--size", type=int, default=256, help="image height/width")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    sample_shape = (3, args.size, args.size)
+    print("batch of {} x {}".format(args.batch_size, sample_shape))
+    print(
+        "{:>8} {:>16} {:>16} {:>8}".format(
+            "pieces", "repeated ms", "concat ms", "speedup"
+        )
+    )
+    for num_pieces in (2, 4, 8, 16, 32):
+        piece_size = args.batch_size // num_pieces
+        pieces = [torch.randn((piece_size,) + sample_shape) for _ in range(num_pieces)]
+        assert torch.equal(concat_repeatedly(pieces), concat_batches(pieces))
+        repeated = min(
+            timeit.repeat(
+                lambda: concat_repeatedly(pieces), number=1, repeat=args.repeat
+            )
+        )
+        concat = min(
+            timeit.repeat(lambda: concat_batches(pieces), number=1, repeat=args.repeat)
+        )
+        print(
+            "{:>8} {:>16.1f} {:>16.1f} {:>7.1f}x".format(
+                num_pieces, repeated * 1e3, concat * 1e3, repeated / concat
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
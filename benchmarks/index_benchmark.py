@@ -0,0 +1,58 @@
+"""Measures the per-sample cost of classifying and looking up indices in a
+`ValidityIndex` for datasets ranging from 1e4 to 1e8 samples.
+
+Run with:
+    $ python benchmarks/index_benchmark.py
+"""
+
+import random
+import timeit
+
+from nonechucks.index import ValidityIndex
+
+SIZES = [10**4, 10**5, 10**6, 10**7, 10**8]
+NUM_OPS = 200000
+FAILURE_RATE = 0.05
+
+
+def bench(length, num_ops=NUM_OPS):
+    rng = random.Random(0)
+    # Each index is classified exactly once, as it would be during an epoch.
+    num_ops = min(num_ops, length)
+    indices = rng.sample(range(length), num_ops)
+    failures = [rng.random() < FAILURE_RATE for _ in range(num_ops)]
+    index = ValidityIndex(length)
+
+    def classify():
+        for idx, failed in zip(indices, failures):
+            if failed:
+                index.mark_unsafe(idx)
+            else:
+                index.mark_safe(idx)
+
+    def lookup():
+        for idx in indices:
+            index.state(idx)
+
+    classify_time = timeit.timeit(classify, number=1)
+    lookup_time = timeit.timeit(lookup, number=1)
+    return classify_time / num_ops * 1e9, lookup_time / num_ops * 1e9
+
+
+def main():
+    print(
+        "{:>12} {:>12} {:>16} {:>16}".format(
+            "samples", "index MiB", "classify ns/op", "lookup ns/op"
+        )
+    )
+    for length in SIZES:
+        classify_ns, lookup_ns = bench(length)
+        print(
+            "{:>12} {:>12.2f} {:>16.1f} {:>16.1f}".format(
+                length, ValidityIndex.nbytes(length) / 2**20, classify_ns, lookup_ns
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
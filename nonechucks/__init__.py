@@ -10,23 +10,16 @@ logger = logging.getLogger(__name__)
 def _get_pytorch_version():
     version = torch.__version__
     major, minor = [int(x) for x in version.split(".")[:2]]
-    if major != 1:
+    if major < 1:
         raise RuntimeError(
-            "nonechucks only supports PyTorch major version 1 at the moment."
-        )
-    if minor > 2:
-        logger.warn(
-            "nonechucks may not work properly with this version of PyTorch ({}). "
-            "It has only been tested on PyTorch versions 1.0, 1.1, and 1.2".format(
-                version
-            )
+            "nonechucks requires PyTorch 1.0 or later, found {}.".format(version)
         )
     return major, minor
 
 
 MAJOR, MINOR = _get_pytorch_version()
 
-if MINOR > 1:
+if (MAJOR, MINOR) > (1, 1):
     SingleProcessDataLoaderIter = (
         torch.utils.data.dataloader._SingleProcessDataLoaderIter
     )
@@ -38,6 +31,18 @@ else:
     MultiProcessingDataLoaderIter = torch.utils.data.dataloader._DataLoaderIter
 
 
-from nonechucks.dataset import SafeDataset
-from nonechucks.sampler import SafeSampler
+from nonechucks.retry import (
+    RetryPolicy,
+    NeverRetry,
+    RetryEveryNEpochs,
+    RetryWithProbability,
+)
+from nonechucks.cache import SampleCache, LRUCache, LFUCache
+from nonechucks.dataset import SafeDataset, AsyncSafeDataset, SafeIterableDataset
+from nonechucks.sampler import (
+    SafeSampler,
+    SafeRandomSampler,
+    DistributedSafeSampler,
+    SafeBatchSampler,
+)
 from nonechucks.dataloader import SafeDataLoader
@@ -0,0 +1,213 @@
+import collections
+import sys
+import threading
+
+import torch
+
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+
+
+def sample_nbytes(sample):
+    """Returns an estimate of the memory held by `sample` in bytes, counting
+    the data of tensors and arrays (and recursing into lists, tuples and
+    dicts) rather than just the size of the Python objects wrapping them."""
+    if isinstance(sample, torch.Tensor):
+        return sample.element_size() * sample.nelement()
+    if hasattr(sample, "nbytes"):  # numpy arrays
+        return int(sample.nbytes)
+    if isinstance(sample, (bytes, bytearray)):
+        return len(sample)
+    if isinstance(sample, str):
+        return sys.getsizeof(sample)
+    if isinstance(sample, Mapping):
+        return sum(sample_nbytes(v) for v in sample.values())
+    if isinstance(sample, (list, tuple)):
+        return sum(sample_nbytes(v) for v in sample)
+    return sys.getsizeof(sample)
+
+
+class SampleCache(object):
+    """Base class of the caches `SafeDataset` can keep loaded samples in.
+
+    A cache holds at most `max_bytes` bytes worth of samples (as measured by
+    `sample_nbytes`), evicting samples chosen by the subclass's policy to make
+    room for new ones; samples larger than `max_bytes` are never cached.
+    `hits` and `misses` count the lookups that found and didn't find a sample
+    respectively.
+
+    Caches are pickled (e.g. when sent to DataLoader workers) without their
+    contents.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = self.misses = 0
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """Returns the sample cached under `key`, or `default` if there is
+        none."""
+        with self._lock:
+            if key in self:
+                self.hits += 1
+                return self._get(key)
+            self.misses += 1
+            return default
+
+    def put(self, key, sample):
+        """Caches `sample` under `key`, evicting other samples if needed."""
+        nbytes = sample_nbytes(sample)
+        if nbytes > self.max_bytes:
+            return
+        with self._lock:
+            if key in self:
+                self.nbytes -= self._pop(key)[1]
+            while self.nbytes + nbytes > self.max_bytes:
+                self.nbytes -= self._evict()[1]
+            self._put(key, (sample, nbytes))
+            self.nbytes += nbytes
+
+    def clear(self):
+        with self._lock:
+            self._clear()
+            self.nbytes = 0
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+        self._clear()
+        self.nbytes = 0
+
+    # Subclasses implement the policy through the following methods, which
+    # store (sample, nbytes) pairs and are always called with the lock held.
+
+    def __contains__(self, key):
+        raise NotImplementedError
+
+    def __len__(self):
+        raise NotImplementedError
+
+    def _get(self, key):
+        """Returns the sample cached under `key`."""
+        raise NotImplementedError
+
+    def _put(self, key, entry):
+        raise NotImplementedError
+
+    def _pop(self, key):
+        """Removes and returns the entry cached under `key`."""
+        raise NotImplementedError
+
+    def _evict(self):
+        """Removes and returns the entry chosen by the eviction policy."""
+        raise NotImplementedError
+
+    def _clear(self):
+        raise NotImplementedError
+
+
+class LRUCache(SampleCache):
+    """Evicts the least recently used sample first."""
+
+    def __init__(self, max_bytes):
+        super(LRUCache, self).__init__(max_bytes)
+        self._entries = collections.OrderedDict()
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _get(self, key):
+        self._entries.move_to_end(key)
+        return self._entries[key][0]
+
+    def _put(self, key, entry):
+        self._entries[key] = entry
+
+    def _pop(self, key):
+        return self._entries.pop(key)
+
+    def _evict(self):
+        return self._entries.popitem(last=False)[1]
+
+    def _clear(self):
+        self._entries = collections.OrderedDict()
+
+
+class LFUCache(SampleCache):
+    """Evicts the least frequently used sample first, breaking ties by
+    evicting the least recently used one."""
+
+    def __init__(self, max_bytes):
+        super(LFUCache, self).__init__(max_bytes)
+        self._clear()
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _get(self, key):
+        entry, freq = self._entries[key]
+        self._remove_from_bucket(key, freq)
+        if self._min_freq == freq and freq not in self._buckets:
+            self._min_freq = freq + 1
+        self._add_to_bucket(key, freq + 1)
+        self._entries[key] = (entry, freq + 1)
+        return entry[0]
+
+    def _put(self, key, entry):
+        self._entries[key] = (entry, 1)
+        self._add_to_bucket(key, 1)
+        self._min_freq = 1
+
+    def _pop(self, key):
+        entry, freq = self._entries.pop(key)
+        self._remove_from_bucket(key, freq)
+        self._update_min_freq()
+        return entry
+
+    def _evict(self):
+        key, _ = self._buckets[self._min_freq].popitem(last=False)
+        entry, freq = self._entries.pop(key)
+        if not self._buckets[freq]:
+            del self._buckets[freq]
+        self._update_min_freq()
+        return entry
+
+    def _clear(self):
+        # key -> ((sample, nbytes), frequency)
+        self._entries = {}
+        # frequency -> keys used that many times, in order of last use
+        self._buckets = {}
+        self._min_freq = 0
+
+    def _add_to_bucket(self, key, freq):
+        self._buckets.setdefault(freq, collections.OrderedDict())[key] = None
+
+    def _remove_from_bucket(self, key, freq):
+        bucket = self._buckets[freq]
+        del bucket[key]
+        if not bucket:
+            del self._buckets[freq]
+
+    def _update_min_freq(self):
+        if self._min_freq not in self._buckets:
+            self._min_freq = min(self._buckets) if self._buckets else 0
@@ -1,3 +1,7 @@
+import collections
+import math
+
+from concurrent.futures import ThreadPoolExecutor
 from functools import partial
 from future.utils import with_metaclass
 
@@ -7,108 +11,461 @@ try:
     from torch.utils.data.dataloader import default_collate
 except ImportError:
     from torch.utils.data._utils.collate import default_collate
+try:
+    from torch.utils.data._utils.pin_memory import pin_memory
+except ImportError:
+    from torch.utils.data.dataloader import pin_memory_batch as pin_memory
 
 from nonechucks import SingleProcessDataLoaderIter, MultiProcessingDataLoaderIter
-from nonechucks.dataset import SafeDataset
-from nonechucks.sampler import SafeSampler
-from nonechucks.utils import batch_len, collate_batches, slice_batch
+from nonechucks.dataset import SafeDataset, SafeIterableDataset
+from nonechucks.sampler import SafeSampler, SafeRandomSampler, SafeBatchSampler
+from nonechucks.utils import BatchSchema, concat_batches
 
 
 class _SafeDataLoaderCaller(type):
     """Metaclass that overrides the __call__ method to replace
-    `SequentialSampler` and `RandomSampler` with their corresponding
-    `SafeSampler`s in DataLoader's namespace.
+    `SequentialSampler` and `RandomSampler` with a `SafeSampler` and a
+    `SafeRandomSampler` respectively in DataLoader's namespace.
     """
 
     def __call__(cls, *args, **kwargs):
-        cls._replace_default_samplers()
-        obj = type.__call__(cls, *args, **kwargs)
-        cls._restore_default_samplers()
-        return obj
+        # Samples are validated as they are loaded (by the workers, if any),
+        # and the short batches that result are filled in by the iterator, so
+        # that no sample is loaded twice and whole batches can be loaded at
+        # once (e.g. concurrently by an AsyncSafeDataset).
+        cls._replace_default_samplers(defer_validation=True)
+        try:
+            return type.__call__(cls, *args, **kwargs)
+        finally:
+            cls._restore_default_samplers()
 
-    def _replace_default_samplers(cls):
+    def _replace_default_samplers(cls, defer_validation=False):
         cls.sequential = data.dataloader.SequentialSampler
         cls.random = data.dataloader.RandomSampler
 
-        def safe_sampler_callable(sampler_cls, dataset):
-            return SafeSampler(dataset, sampler_cls(dataset))
+        def safe_sampler_callable(sampler_cls, dataset, **kwargs):
+            # The DataLoader's dataset is the _OriginalDataset wrapping the
+            # SafeDataset passed in.
+            dataset = dataset.safe_dataset
+            return SafeSampler(
+                dataset,
+                sampler_cls(dataset, **kwargs),
+                defer_validation=defer_validation,
+            )
 
         data.dataloader.SequentialSampler = partial(
             safe_sampler_callable, data.SequentialSampler
         )
-        data.dataloader.RandomSampler = partial(
-            safe_sampler_callable, data.RandomSampler
-        )
+
+        def safe_random_sampler_callable(dataset, generator=None):
+            return SafeRandomSampler(
+                dataset.safe_dataset,
+                generator=generator,
+                defer_validation=defer_validation,
+            )
+
+        data.dataloader.RandomSampler = safe_random_sampler_callable
 
     def _restore_default_samplers(cls):
         data.dataloader.SequentialSampler = cls.sequential
         data.dataloader.RandomSampler = cls.random
 
 
-class _SafeDataLoaderIter(MultiProcessingDataLoaderIter):
-    def __init__(self, loader):
-        super().__init__(loader)
-        self.batch_size = loader.batch_size
-        self.coalescing_in_progress = False
-        self.drop_last = loader.drop_last_original
-        if isinstance(loader.sampler, SafeSampler):
-            self.step_to_index_fn = loader.sampler.step_to_index_fn
-        else:
-            self.step_to_index_fn = SafeSampler.default_step_to_index_fn
-
-    def _process_next_batch(self, curr_batch):
-        """Fills an incomplete batch if necessary before processing it."""
-        super()._process_next_batch(curr_batch)
-        if self.coalescing_in_progress:
-            return curr_batch
-
-        # When set to True, _process_next_batch simply returns an incomplete
-        # batch instead of trying to fill it up to a length of batch_size.
-        #
-        # Stays True until the current batch is filled so that nested calls for
-        # _process_next_batch from within the loop simply call the parent's
-        # version of the _process_next_batch.
-        self.coalescing_in_progress = True
-        n_empty_slots = self.batch_size - batch_len(curr_batch)
+# Whether DataLoader iterators load batches through the _next_data hook, which
+# __next__ wraps with the bookkeeping common to all iterators.
+_HAS_NEXT_DATA = hasattr(SingleProcessDataLoaderIter, "_next_data")
+
+
+def _pin_batch(batch, device=None):
+    """Returns `batch` in memory pinned for `device` (CUDA by default)."""
+    if device:
+        return pin_memory(batch, device)
+    return pin_memory(batch)
+
+
+# A batch in the coalescer's pool: `batch` is the batch as loaded, or None if
+# it has been sliced, in which case it is rebuilt from `leaves` (as flattened
+# by `schema`) when needed.
+_Piece = collections.namedtuple("_Piece", ["batch", "schema", "leaves", "length"])
+
+
+class _BatchCoalescer(object):
+    """Cuts the stream of batches loaded by a `DataLoader`, which come back
+    short whenever unsafe samples are dropped (or long, when over-provisioned),
+    into batches of exactly `batch_size` samples.
+
+    Samples that don't fit into the batch being assembled are kept in a
+    carry-over pool and make up the start of the next one. A batch that fits
+    exactly is returned as is, without being copied.
+
+    The structure of the batches is inferred from the first one and reused
+    for all the following ones, which are only examined in full again if
+    their structure turns out to be different.
+
+    If `pin_memory` is True, every batch returned is in memory pinned for
+    `pin_memory_device`: batches made up of several pieces are assembled
+    straight into pinned buffers, and the others are pinned as well, unless
+    `pinned_input` is True, meaning that the batches added are pinned already
+    (e.g. by the DataLoader's pin memory thread).
+    """
+
+    def __init__(
+        self,
+        batch_size,
+        drop_last=False,
+        pin_memory=False,
+        pin_memory_device=None,
+        pinned_input=False,
+    ):
+        self.batch_size = batch_size
+        self.drop_last = drop_last
+        self.pin_memory = pin_memory
+        self.pin_memory_device = pin_memory_device
+        self.pinned_input = pinned_input
+        self.schema = None
+        self._pieces = collections.deque()
+        self._num_samples = 0
+
+    def __len__(self):
+        """Returns the number of samples in the pool."""
+        return self._num_samples
+
+    def add(self, batch):
+        """Adds `batch` to the pool and returns the number of samples in
+        it."""
+        if len(batch) == 0:
+            return 0
+        leaves = self._flatten(batch)
+        return self._append(batch, leaves, len(leaves[0]))
+
+    def offer(self, batch):
+        """Returns `batch` (pinned if need be) along with the number of
+        samples in it if it makes up a full batch on its own, i.e. the pool is
+        empty and it holds exactly `batch_size` samples, so that it skips the
+        pool. Otherwise, adds it to the pool and returns None along with the
+        number of samples in it."""
+        if len(batch) == 0:
+            return None, 0
+        leaves = self._flatten(batch)
+        length = len(leaves[0])
+        if self._num_samples == 0 and length == self.batch_size:
+            return self.pin(batch), length
+        return None, self._append(batch, leaves, length)
+
+    def _append(self, batch, leaves, length):
+        self._pieces.append(_Piece(batch, self.schema, leaves, length))
+        self._num_samples += length
+        return length
+
+    def pin(self, batch):
+        """Returns `batch`, which is made up of a single piece, in pinned
+        memory if `pin_memory` is True."""
+        if not self.pin_memory or self.pinned_input:
+            return batch
+        return _pin_batch(batch, self.pin_memory_device)
+
+    def _flatten(self, batch):
+        if self.schema is not None:
+            try:
+                return self.schema.flatten(batch)
+            except ValueError:
+                pass
+        self.schema = BatchSchema(batch)
+        return self.schema.flatten(batch)
+
+    def pop(self, final=False):
+        """Returns the next full batch, or None if the pool doesn't hold
+        enough samples for one. If `final` is True, the samples left over at
+        the end of the epoch are returned as a last, incomplete batch (unless
+        `drop_last` is set)."""
+        num_samples = self.batch_size
+        if self._num_samples < self.batch_size:
+            if not final or self._num_samples == 0 or self.drop_last:
+                return None
+            num_samples = self._num_samples
+
+        pieces = []
+        n_empty_slots = num_samples
         while n_empty_slots > 0:
-            # check if curr_batch is the final batch
-            if self.batches_outstanding == 0 and not self.reorder_dict:
-                if (not self.drop_last) or (batch_len(curr_batch) == self.batch_size):
-                    return curr_batch
-
-            # raises StopIteration if no more elements left, which exits the
-            # loop
-            next_batch = next(self)
-            if len(next_batch) == 0:
-                super()._process_next_batch(next_batch)
-                continue
-            elif len(next_batch) > n_empty_slots:
-                # Take only n_empty_slots number of samples from next_batch.
-                # The remaining elements of next_batch are added back into the
-                # dict for future consumption.
-                self.rcvd_idx -= 1
-                curr_batch = collate_batches(
-                    [curr_batch, slice_batch(next_batch, end=n_empty_slots)]
+            piece = self._pieces.popleft()
+            if piece.length > n_empty_slots:
+                self._pieces.appendleft(
+                    _Piece(
+                        None,
+                        piece.schema,
+                        [leaf[n_empty_slots:] for leaf in piece.leaves],
+                        piece.length - n_empty_slots,
+                    )
                 )
-                self.reorder_dict[self.rcvd_idx] = slice_batch(
-                    next_batch, start=n_empty_slots
+                piece = _Piece(
+                    None,
+                    piece.schema,
+                    [leaf[:n_empty_slots] for leaf in piece.leaves],
+                    n_empty_slots,
                 )
-            else:
-                curr_batch = collate_batches([curr_batch, next_batch])
+            pieces.append(piece)
+            n_empty_slots -= piece.length
+        self._num_samples -= num_samples
+
+        if len(pieces) == 1:
+            batch = pieces[0].batch
+            if batch is None:
+                batch = pieces[0].schema.unflatten(pieces[0].leaves)
+            return self.pin(batch)
+        # The pieces are only concatenated once the batch is full, so that its
+        # tensors are allocated (and each sample copied) exactly once.
+        schema = pieces[0].schema
+        if all(piece.schema is schema for piece in pieces):
+            leaves = schema.concat(
+                [piece.leaves for piece in pieces],
+                pin_memory=self.pin_memory,
+                pin_memory_device=self.pin_memory_device,
+            )
+            return schema.unflatten(leaves)
+        # The structure changed partway through the batch.
+        batches = [
+            piece.schema.unflatten(piece.leaves) if piece.batch is None else piece.batch
+            for piece in pieces
+        ]
+        return concat_batches(
+            batches,
+            pin_memory=self.pin_memory,
+            pin_memory_device=self.pin_memory_device,
+        )
+
+
+class _SafeDataLoaderIterMixin(object):
+    """Makes a DataLoader iterator return batches of exactly `batch_size`
+    samples, filling in the batches that came back short from the ones that
+    follow them.
+
+    With `pin_memory` set, batches are pinned as they are loaded (e.g. by the
+    DataLoader's pin memory thread) if `_loads_pinned_batches` is True, in
+    which case the coalescer only assembles the batches made up of several
+    pieces straight into pinned buffers. Otherwise, the coalescer pins every
+    batch once it is complete.
+    """
+
+    _loads_pinned_batches = True
+
+    def __init__(self, loader):
+        super().__init__(loader)
+        self._init_coalescing(loader)
+
+    def _reset(self, loader, first_iter=False):
+        # Called at the start of every epoch by iterators over persistent
+        # workers, which are reused across epochs.
+        super()._reset(loader, first_iter)
+        self._init_coalescing(loader)
+
+    def _init_coalescing(self, loader):
+        self.batch_size = loader.target_batch_size
+        self.drop_last = loader.drop_last_original
+        self.coalescer = _BatchCoalescer(
+            self.batch_size,
+            self.drop_last,
+            pin_memory=getattr(self, "_pin_memory", False),
+            pin_memory_device=getattr(self, "_pin_memory_device", None),
+            pinned_input=self._loads_pinned_batches,
+        )
+        self.overprovisioner = None
+        if isinstance(loader.batch_sampler, _OverprovisioningBatchSampler):
+            self.overprovisioner = loader.batch_sampler
+
+    def _next_data(self):
+        if self.batch_size is None:
+            return self._next_loaded_batch()
+        while True:
+            batch = self.coalescer.pop()
+            if batch is not None:
+                return batch
+            try:
+                batch = self._next_loaded_batch()
+            except StopIteration:
+                batch = self.coalescer.pop(final=True)
+                if batch is None:
+                    raise
+                return batch
+            # A full batch with nothing to fill in or carry over is returned
+            # without going through the pool.
+            batch, num_loaded = self.coalescer.offer(batch)
+            if self.overprovisioner is not None:
+                self.overprovisioner.record(num_loaded)
+            if batch is not None:
+                return batch
+
+    def _next_loaded_batch(self):
+        """Returns the next batch as loaded by the parent iterator."""
+        if _HAS_NEXT_DATA:
+            return super()._next_data()
+        return super().__next__()
+
+    if not _HAS_NEXT_DATA:
+        # Before PyTorch 1.4, batches are loaded by __next__ itself.
+        def __next__(self):
+            return self._next_data()
 
-            n_empty_slots -= min(n_empty_slots, batch_len(next_batch))
-        self.coalescing_in_progress = False
-        return curr_batch
+        # For Python2 compatibility
+        next = __next__
 
 
-class _OriginalDataset(SafeDataset):
+class _SafeSingleProcessDataLoaderIter(
+    _SafeDataLoaderIterMixin, SingleProcessDataLoaderIter
+):
+    # Batches are loaded in the main process either way, so they are left for
+    # the coalescer to pin once they are complete.
+    _loads_pinned_batches = not _HAS_NEXT_DATA
+
+    def _next_loaded_batch(self):
+        if not _HAS_NEXT_DATA:
+            return super()._next_loaded_batch()
+        return self._dataset_fetcher.fetch(self._next_index())
+
+
+class _SafeDataLoaderIter(_SafeDataLoaderIterMixin, MultiProcessingDataLoaderIter):
+    pass
+
+
+class _ThreadPoolDataLoaderIter(SingleProcessDataLoaderIter):
+    """Loads batches in the main process on a pool of `loader.num_threads`
+    threads, keeping up to two batches per thread in flight.
+
+    With `pin_memory` set, each batch is pinned by the thread that loads it.
+    """
+
+    def __init__(self, loader):
+        super().__init__(loader)
+        self._executor = ThreadPoolExecutor(max_workers=loader.num_threads)
+        self._prefetch = 2 * loader.num_threads
+        self._pending = collections.deque()
+
+    def _next_data(self):
+        while len(self._pending) < self._prefetch:
+            try:
+                index = self._next_index()
+            except StopIteration:
+                break
+            self._pending.append(self._executor.submit(self._fetch, index))
+        if not self._pending:
+            self._shutdown()
+            raise StopIteration
+        return self._pending.popleft().result()
+
+    def _fetch(self, index):
+        batch = self._dataset_fetcher.fetch(index)
+        if self._pin_memory:
+            batch = _pin_batch(batch, getattr(self, "_pin_memory_device", None))
+        return batch
+
+    def _shutdown(self):
+        for future in self._pending:
+            future.cancel()
+        self._executor.shutdown(wait=False)
+
+    def __del__(self):
+        if hasattr(self, "_executor"):
+            self._shutdown()
+
+
+class _SafeThreadPoolDataLoaderIter(
+    _SafeDataLoaderIterMixin, _ThreadPoolDataLoaderIter
+):
+    pass
+
+
+class _OverprovisioningBatchSampler(data.BatchSampler):
+    """A BatchSampler that asks for more than `batch_size` indices per batch
+    to make up for the samples expected to be dropped from it.
+
+    The failure rate `p` is measured over the batches loaded so far (reported
+    through `record`), and each batch is made up of `batch_size * (1 + p)`
+    indices plus `margin`. The surplus samples are carried over to the next
+    batch by the DataLoader iterator.
+    """
+
+    def __init__(self, sampler, batch_size, margin=1):
+        super(_OverprovisioningBatchSampler, self).__init__(
+            sampler, batch_size, drop_last=False
+        )
+        self.margin = margin
+        self.num_requested = self.num_loaded = 0
+        # Sizes of the batches handed out but not yet loaded, oldest first.
+        self._outstanding = collections.deque()
+
+    @property
+    def failure_rate(self):
+        if self.num_requested == 0:
+            return 0.0
+        return 1.0 - self.num_loaded / self.num_requested
+
+    def record(self, num_loaded):
+        """Records that the oldest outstanding batch was loaded with
+        `num_loaded` samples left in it."""
+        if self._outstanding:
+            self.num_requested += self._outstanding.popleft()
+            self.num_loaded += num_loaded
+
+    def request_size(self):
+        return int(math.ceil(self.batch_size * (1 + self.failure_rate))) + self.margin
+
+    def __iter__(self):
+        self._outstanding.clear()
+        batch = []
+        for idx in self.sampler:
+            batch.append(idx)
+            if len(batch) >= self.request_size():
+                self._outstanding.append(len(batch))
+                yield batch
+                batch = []
+        if len(batch) > 0:
+            self._outstanding.append(len(batch))
+            yield batch
+
+
+class _OriginalDataset(data.Dataset):
     """Wraps a SafeDataset to return None for invalid samples."""
 
-    def __init__(self, safe_dataset):
+    def __init__(self, safe_dataset, backfill=False):
         self.safe_dataset = safe_dataset
+        self.backfill = backfill
+
+    def __len__(self):
+        return len(self.safe_dataset)
 
     def __getitem__(self, idx):
-        return self.safe_dataset._safe_get_item(idx)
+        sample = self.safe_dataset._safe_get_item(idx)
+        if sample is None and self.backfill:
+            sample = self._backfill([idx], [sample])[0]
+        return sample
+
+    def __getitems__(self, indices):
+        """Loads a whole batch at once (as of PyTorch 2.1), letting datasets
+        such as `AsyncSafeDataset` fetch its samples concurrently."""
+        samples = self.safe_dataset._safe_get_items(indices)
+        if self.backfill and None in samples:
+            samples = self._backfill(indices, samples)
+        return samples
+
+    def _backfill(self, indices, samples):
+        """Replaces each None in `samples`, loaded from `indices`, by a safe
+        sample whose index is not in `indices`, or by no other replacement.
+        Replacements are looked for after the last index of the batch,
+        wrapping around to the start of the dataset."""
+        replacements = self._replacements(max(indices) + 1, set(indices))
+        return [
+            next(replacements, None) if sample is None else sample for sample in samples
+        ]
+
+    def _replacements(self, start, excluded):
+        """Yields the safe samples from `start` onwards, then from the start
+        of the dataset up to `start`, leaving out the indices in `excluded`."""
+        safe_dataset = self.safe_dataset
+        for begin, end in ((start, None), (0, start)):
+            for idx in safe_dataset._candidate_indices(begin, end):
+                if idx not in excluded:
+                    sample = safe_dataset._safe_get_item(idx)
+                    if sample is not None:
+                        yield sample
 
 
 class SafeDataLoader(with_metaclass(_SafeDataLoaderCaller, data.DataLoader)):
@@ -123,27 +480,146 @@ class SafeDataLoader(with_metaclass(_SafeDataLoaderCaller, data.DataLoader)):
             return []
         return default_collate(filtered_batch)
 
-    def __init__(self, dataset, **kwargs):
+    def __init__(
+        self,
+        dataset,
+        worker_backfill=False,
+        overprovision=False,
+        overprovision_margin=1,
+        num_threads=0,
+        share_index=True,
+        **kwargs
+    ):
+        """Creates a `SafeDataLoader` over `dataset`, which must be a
+        `SafeDataset` or a `SafeIterableDataset`. All keyword arguments other
+        than the ones below are passed on to `DataLoader`.
+
+        Arguments:
+            worker_backfill (bool, optional): If True, whoever loads a batch
+                (i.e. the worker process, if any) replaces each unsafe sample
+                in it by the next safe sample of the dataset right away, so
+                that full batches are returned without the main process having
+                to fill them in. The replacements are never taken from the
+                same batch, but may repeat samples that appear elsewhere in the
+                epoch.
+            overprovision (bool, optional): If True, every batch is loaded
+                from slightly more than `batch_size` indices, based on the
+                fraction of samples dropped so far (`batch_size * (1 + p) +
+                overprovision_margin` for a failure rate of `p`), so that
+                batches rarely come back short and need to be filled in. The
+                surplus samples are carried over to the next batch. Cannot be
+                combined with a custom `batch_sampler`.
+            overprovision_margin (int, optional): The number of indices added
+                on top of the expected number of failures when
+                `overprovision` is True.
+            num_threads (int, optional): If greater than 0, batches are loaded
+                by that many threads of the main process instead of worker
+                processes, which saves sending the dataset to every worker and
+                every batch back from it. Suits datasets that release the GIL
+                while loading samples (e.g. waiting on I/O or decoding
+                images). Cannot be combined with `num_workers`.
+            share_index (bool, optional): If True and `num_workers` is
+                greater than 0, the index of safe and unsafe samples of
+                `dataset` is moved into shared memory (see
+                `SafeDataset.share_memory_`), so that the samples found to be
+                unsafe by any worker (and the epochs they failed in) are known
+                to all of them and to this process, and outlive the workers.
+                The dataset's `retry_policy` must be set before creating the
+                DataLoader for the latter to be shared. The dataset stays shared
+                once the DataLoader is gone; copies made of it (e.g. with
+                `copy.deepcopy` or `pickle`) are not.
+
+        `worker_backfill`, `overprovision` and `num_threads` aren't supported
+        for a `SafeIterableDataset`.
+        """
         # drop_last is handled transparently by _SafeDataLoaderIter (bypassing
         # DataLoader). Since drop_last cannot be changed after initializing the
         # DataLoader instance, it needs to be intercepted here.
         assert isinstance(
-            dataset, SafeDataset
-        ), "dataset must be an instance of SafeDataset."
+            dataset, (SafeDataset, SafeIterableDataset)
+        ), "dataset must be an instance of SafeDataset or SafeIterableDataset."
+        is_iterable = isinstance(dataset, SafeIterableDataset)
+        assert not is_iterable or not (
+            worker_backfill or overprovision or num_threads
+        ), "worker_backfill, overprovision and num_threads require a SafeDataset."
+
+        assert (
+            num_threads == 0 or kwargs.get("num_workers", 0) == 0
+        ), "num_threads cannot be combined with num_workers."
+        assert (
+            num_threads == 0 or _HAS_NEXT_DATA
+        ), "num_threads is not supported by this version of PyTorch."
+        self.num_threads = num_threads
 
         self.drop_last_original = False
         if "drop_last" in kwargs:
             self.drop_last_original = kwargs["drop_last"]
             kwargs["drop_last"] = False
-        super(SafeDataLoader, self).__init__(dataset, **kwargs)
+        batch_size = kwargs.get("batch_size", 1)
+        if overprovision:
+            kwargs = self._overprovisioned_kwargs(
+                dataset, overprovision_margin, **kwargs
+            )
+        if kwargs.get("collate_fn") in (None, default_collate):
+            kwargs["collate_fn"] = SafeDataLoader._safe_default_collate
 
-        self.safe_dataset = self.dataset
-        self.dataset = _OriginalDataset(self.safe_dataset)
+        self.safe_dataset = dataset
+        if not is_iterable:
+            if share_index and kwargs.get("num_workers", 0) > 0:
+                # Lets every worker see the samples dropped by the others.
+                try:
+                    self.safe_dataset.share_memory_()
+                except RuntimeError:
+                    pass
+            # The dataset can't be replaced once the DataLoader is initialized
+            # (as of PyTorch 1.2), so the wrapper is passed in right away.
+            dataset = _OriginalDataset(dataset, backfill=worker_backfill)
+        # Samples are dropped from a SafeIterableDataset as they are streamed,
+        # and only the last batch of each worker can come back short.
+        super(SafeDataLoader, self).__init__(dataset, **kwargs)
+        # The size of the batches returned, which the batches loaded are cut
+        # to (None for a custom batch_sampler, whose batches are left as is).
+        self.target_batch_size = batch_size if overprovision else self.batch_size
+        if isinstance(self.batch_sampler, SafeBatchSampler):
+            # Its batches only come back short if samples it couldn't rule
+            # out turn out to be unsafe, and are filled in like any other.
+            self.target_batch_size = self.batch_sampler.batch_size
+            self.drop_last_original = self.batch_sampler.drop_last
 
-        if self.collate_fn is default_collate:
-            self.collate_fn = SafeDataLoader._safe_default_collate
+    @staticmethod
+    def _overprovisioned_kwargs(dataset, margin, **kwargs):
+        """Replaces the `batch_size`, `shuffle` and `sampler` arguments with
+        an `_OverprovisioningBatchSampler` over the equivalent `SafeSampler`."""
+        assert (
+            kwargs.get("batch_sampler") is None
+        ), "overprovision cannot be combined with a custom batch_sampler."
+        batch_size = kwargs.pop("batch_size", 1)
+        shuffle = kwargs.pop("shuffle", False)
+        sampler = kwargs.pop("sampler", None)
+        kwargs.pop("drop_last", None)
+        if sampler is None:
+            # Samples are validated as they are loaded, which is what the
+            # failure rate is measured on.
+            if shuffle:
+                sampler = SafeRandomSampler(
+                    dataset, generator=kwargs.get("generator"), defer_validation=True
+                )
+            else:
+                sampler = SafeSampler(dataset, defer_validation=True)
+        kwargs["batch_sampler"] = _OverprovisioningBatchSampler(
+            sampler, batch_size, margin=margin
+        )
+        return kwargs
 
-    def __iter__(self):
+    def _get_iterator(self):
         if self.num_workers > 0:
             return _SafeDataLoaderIter(self)
-        return SingleProcessDataLoaderIter(self)
+        if self.num_threads > 0:
+            return _SafeThreadPoolDataLoaderIter(self)
+        return _SafeSingleProcessDataLoaderIter(self)
+
+    def __iter__(self):
+        if hasattr(data.DataLoader, "_get_iterator"):
+            # Lets DataLoader reuse the iterator over persistent workers.
+            return super(SafeDataLoader, self).__iter__()
+        return self._get_iterator()
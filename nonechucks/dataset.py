@@ -1,74 +1,376 @@
+import asyncio
+import collections
+import hashlib
+import inspect
+import itertools
+import logging
+import multiprocessing
+import os
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+
 import torch
 import torch.utils.data
 
-from nonechucks.utils import memoize
+from nonechucks.index import ValidityIndex
+from nonechucks.retry import NeverRetry
+
+logger = logging.getLogger(__name__)
+
+
+def _is_safe_sample(dataset, idx):
+    """Returns True if the sample at `idx` is valid according to the dataset's
+    `is_valid` method if it has one, or if it loads without raising an error
+    and isn't None otherwise."""
+    try:
+        is_valid = getattr(dataset, "is_valid", None)
+        if is_valid is not None:
+            return bool(is_valid(idx))
+        return dataset[idx] is not None
+    except Exception:
+        return False
+
+
+# The dataset being indexed by the current index-building worker process.
+_worker_dataset = None
+
+
+def _init_index_worker(dataset):
+    global _worker_dataset
+    _worker_dataset = dataset
+
+
+def _build_index_chunk(bounds):
+    """Classifies the samples in `range(*bounds)` of the worker's dataset and
+    returns the start of the chunk along with its index buffer."""
+    start, end = bounds
+    index = ValidityIndex(end - start)
+    for idx in range(start, end):
+        if _is_safe_sample(_worker_dataset, idx):
+            index.mark_safe(idx - start)
+        else:
+            index.mark_unsafe(idx - start)
+    return start, bytes(index.buffer)
+
+
+def _close_event_loops(loops):
+    """Closes the event loops an `AsyncSafeDataset` created for its
+    synchronous calls once the dataset is gone."""
+    for loop in loops:
+        if not loop.is_running():
+            loop.close()
 
 
 class SafeDataset(torch.utils.data.Dataset):
     """A wrapper around a torch.utils.data.Dataset that allows dropping
     samples dynamically.
+
+    If the wrapped dataset defines an `is_valid(idx)` method that cheaply
+    checks whether a sample can be loaded (e.g. by checking that its file
+    exists or has a valid header), it is used instead of fully loading
+    samples while building the index and while sampling with `SafeSampler`.
     """
 
-    def __init__(self, dataset, eager_eval=False):
-        """Creates a `SafeDataset` wrapper around `dataset`."""
+    def __init__(
+        self,
+        dataset,
+        eager_eval=False,
+        retry_policy=None,
+        index_path=None,
+        index_version=None,
+        index_chunk_size=1024,
+        cache=None,
+        prefetch=0,
+    ):
+        """Creates a `SafeDataset` wrapper around `dataset`.
+
+        Arguments:
+            dataset (Dataset): The dataset to be wrapped.
+            eager_eval (bool or int, optional): If True, every sample is
+                loaded once upfront to build the index of safe and unsafe
+                samples. If an integer, the index is built in parallel by that
+                many worker processes.
+            retry_policy (RetryPolicy, optional): Decides whether samples
+                already known to be unsafe are loaded again (e.g. to recover
+                from transient failures). If None, unsafe samples are never
+                loaded again.
+            index_path (str, optional): File the index is loaded from (if it
+                exists and matches this dataset) and saved to after
+                `eager_eval` builds it. Loading memory-maps the file, so it
+                takes constant time regardless of the size of the dataset.
+            index_version (str, optional): Identifies the contents of
+                `dataset`; together with its length, it forms the fingerprint
+                that a saved index must match to be loaded. Change it whenever
+                the underlying data changes.
+            index_chunk_size (int, optional): Number of samples handed to a
+                worker process at a time when `eager_eval` is an integer.
+            cache (SampleCache, optional): Cache for the samples returned by
+                `__getitem__`, e.g. `LRUCache(max_bytes)` or
+                `LFUCache(max_bytes)`. If None, samples aren't cached.
+            prefetch (int, optional): Number of samples loaded ahead on a
+                pool of background threads when iterating over the dataset.
+        """
         self.dataset = dataset
         self.eager_eval = eager_eval
-        # These will contain indices over the original dataset. The indices of
-        # the safe samples will go into _safe_indices and similarly for unsafe
-        # samples.
-        self._safe_indices = []
-        self._unsafe_indices = []
+        if retry_policy is None:
+            retry_policy = NeverRetry()
+        self.retry_policy = retry_policy
+        self.cache = cache
+        self.prefetch = prefetch
+        self.epoch = 0
+        # Records, for every index over the original dataset, whether the
+        # sample is safe, unsafe or yet to be examined.
+        self._index = ValidityIndex(len(self.dataset))
+        # The epoch every unsafe sample last failed in (-1 if not known),
+        # which is what retry_policy bases its decisions on. Only allocated
+        # once a sample fails under a policy that looks at it.
+        self._failed_epochs = None
+
+        self.index_path = index_path
+        self.index_version = index_version
+        if index_path is not None and os.path.exists(index_path):
+            try:
+                self.load_index(index_path)
+            except ValueError as e:
+                logger.warning("Ignoring saved index: {}".format(e))
 
         # If eager_eval is True, we can simply go ahead and build the index
         # by attempting to access every sample in self.dataset.
-        if self.eager_eval is True:
-            self._build_index()
+        self.index_chunk_size = index_chunk_size
+        if self.eager_eval and not self.is_index_built:
+            self._build_and_save_index()
 
-    def _safe_get_item(self, idx):
+    def _safe_get_item(self, idx, retry_checked=False):
         """Returns None instead of throwing an error when dealing with an
         unsafe sample, and also builds an index of safe and unsafe samples as
         and when they get accessed.
+
+        If `retry_checked` is True, the caller has already decided (through
+        `_is_known_unsafe`) that the sample is to be loaded, and the retry
+        policy isn't consulted again.
         """
+        # Raised outside the try block to differentiate an invalid index from
+        # an IndexError occuring during sample loading.
+        idx = self._check_index(idx)
         try:
-            # differentiates IndexError occuring here from one occuring during
-            # sample loading
-            invalid_idx = False
-            if idx >= len(self.dataset):
-                invalid_idx = True
-                raise IndexError
-            sample = self.dataset[idx]
-            if idx not in self._safe_indices:
-                self._safe_indices.append(idx)
-            return sample
-        except Exception as e:
-            if isinstance(e, IndexError):
-                if invalid_idx:
-                    raise
-            if idx not in self._unsafe_indices:
-                self._unsafe_indices.append(idx)
+            # Samples already known to be unsafe are dropped without loading
+            # them again, unless the retry policy says otherwise.
+            if not retry_checked and self._is_known_unsafe(idx):
+                return None
+            return self._record_sample(idx, self.dataset[idx])
+        except Exception:
+            self._mark_unsafe(idx)
+            return None
+
+    def _safe_get_items(self, indices):
+        """Returns the samples at `indices` as loaded by `_safe_get_item`,
+        with None in place of the unsafe ones."""
+        return [self._safe_get_item(idx) for idx in indices]
+
+    def _record_sample(self, idx, sample):
+        """Marks `idx` as safe or unsafe depending on whether the `sample`
+        loaded from it is None, and returns the sample."""
+        if sample is None:
+            self._mark_unsafe(idx)
+            return None
+        self._index.mark_safe(idx)
+        self._forget_failure(idx)
+        return sample
+
+    def _probe_item(self, idx, load=True):
+        """Returns True if the sample at `idx` is safe, going by the index if
+        it has already been examined, and otherwise by the wrapped dataset's
+        `is_valid` method if it has one. When neither is available, the
+        sample is loaded through `_safe_get_item` if `load` is True, and
+        assumed to be safe without being examined otherwise.
+
+        Unsafe samples are examined again if the retry policy allows it. If
+        `load` is False and the policy isn't deterministic, they are assumed
+        to be safe, leaving the decision to whoever loads them so that the
+        policy is only consulted once.
+        """
+        idx = self._check_index(idx)
+        if self._index.is_safe(idx):
+            return True
+        if self._index.is_unsafe(idx):
+            if not load and not self.retry_policy.deterministic:
+                return True
+            if self._is_known_unsafe(idx):
+                return False
+        is_valid = getattr(self.dataset, "is_valid", None)
+        if is_valid is None:
+            return not load or self._safe_get_item(idx, retry_checked=True) is not None
+        try:
+            valid = bool(is_valid(idx))
+        except Exception:
+            valid = False
+        if valid:
+            self._index.mark_safe(idx)
+            self._forget_failure(idx)
+        else:
+            self._mark_unsafe(idx)
+        return valid
+
+    def _check_index(self, idx):
+        """Returns `idx` as a non-negative index, raising an `IndexError` if
+        it is out of range."""
+        if idx < 0:
+            idx += len(self.dataset)
+        if not 0 <= idx < len(self.dataset):
+            raise IndexError
+        return idx
+
+    def _is_known_unsafe(self, idx):
+        """Returns True if `idx` is known to be unsafe and the retry policy
+        doesn't allow it to be examined again."""
+        if not self._index.is_unsafe(idx):
+            return False
+        failed_epoch = self.epoch
+        if self.retry_policy.uses_failed_epoch:
+            failed_epoch = self._failed_epoch(idx)
+            if failed_epoch is None:
+                # The sample failed before the policy started keeping track
+                # (e.g. it was loaded from a saved index), so it's retried to
+                # find out.
+                return False
+        return not self.retry_policy.should_retry(idx, self.epoch, failed_epoch)
+
+    def _failed_epoch(self, idx):
+        """Returns the epoch the unsafe sample at `idx` last failed in, or None
+        if that isn't known."""
+        if self._failed_epochs is None:
             return None
+        epoch = int(self._failed_epochs[idx])
+        return epoch if epoch >= 0 else None
 
-    def _build_index(self):
+    def _mark_unsafe(self, idx):
+        self._index.mark_unsafe(idx)
+        if self.retry_policy.uses_failed_epoch:
+            self._allocate_failed_epochs()
+            self._failed_epochs[idx] = self.epoch
+
+    def _allocate_failed_epochs(self):
+        if self._failed_epochs is None:
+            self._failed_epochs = torch.full(
+                (len(self.dataset),), -1, dtype=torch.int32
+            )
+
+    def _forget_failure(self, idx):
+        if self._failed_epochs is not None:
+            self._failed_epochs[idx] = -1
+
+    def set_epoch(self, epoch):
+        """Sets the current epoch, which is used by `retry_policy` to decide
+        when unsafe samples should be loaded again."""
+        self.epoch = epoch
+
+    def _build_index(self, num_workers=0, chunk_size=1024):
+        """Classifies every sample that hasn't been examined yet, spreading
+        the work over `num_workers` processes (in chunks of `chunk_size`
+        samples) if `num_workers` is greater than 0.
+        """
+        if num_workers > 0:
+            return self._build_index_parallel(num_workers, chunk_size)
         for idx in range(len(self.dataset)):
-            # The returned sample is deliberately discarded because
-            # self._safe_get_item(idx) is called only to classify every index
-            # into either safe_samples_indices or _unsafe_samples_indices.
-            _ = self._safe_get_item(idx)
+            if self._index.state(idx) == ValidityIndex.UNKNOWN:
+                self._probe_item(idx)
+
+    def _build_index_parallel(self, num_workers, chunk_size):
+        # Chunks have to start on a byte boundary of the index's bitmaps to be
+        # merged back into it.
+        chunk_size = max(8, (chunk_size + 7) // 8 * 8)
+        length = len(self.dataset)
+        chunks = [
+            (start, min(start + chunk_size, length))
+            for start in range(0, length, chunk_size)
+        ]
+        num_done = 0
+        next_report = 0.1
+        pool = multiprocessing.Pool(
+            num_workers, initializer=_init_index_worker, initargs=(self.dataset,)
+        )
+        try:
+            for start, buffer in pool.imap_unordered(_build_index_chunk, chunks):
+                chunk_length = min(chunk_size, length - start)
+                chunk_index = ValidityIndex(chunk_length, buffer=bytearray(buffer))
+                self._index.merge(chunk_index, start)
+                num_done += chunk_length
+                if num_done >= next_report * length:
+                    logger.info(
+                        "Built index for {}/{} samples ({:.0%})".format(
+                            num_done, length, num_done / length
+                        )
+                    )
+                    next_report = num_done / length + 0.1
+        finally:
+            pool.terminate()
+
+    def share_memory_(self):
+        """Moves the index of safe and unsafe samples into shared memory, so
+        that samples found to be unsafe by any process (e.g. a DataLoader
+        worker) are immediately known to all others, and outlive the worker
+        processes that found them. The epochs the samples failed in are
+        shared along with them if the retry policy looks at them, so the
+        policy should be set beforehand. Returns the dataset itself.
+        """
+        self._index.share_memory_()
+        if self.retry_policy.uses_failed_epoch:
+            self._allocate_failed_epochs()
+            self._failed_epochs.share_memory_()
+        return self
+
+    def compact(self):
+        """Returns a `CompactSafeDataset` view containing only the safe
+        samples of this dataset, building the index first if needed."""
+        if not self.is_index_built:
+            self._build_and_save_index()
+        return CompactSafeDataset(self)
+
+    def _build_and_save_index(self):
+        """Builds the index with as many worker processes as `eager_eval`
+        asks for, and saves it to `index_path` if there is one."""
+        num_workers = 0 if isinstance(self.eager_eval, bool) else int(self.eager_eval)
+        self._build_index(num_workers=num_workers, chunk_size=self.index_chunk_size)
+        if self.index_path is not None:
+            self.save_index(self.index_path)
+
+    @property
+    def _index_fingerprint(self):
+        key = "{}:{}".format(len(self.dataset), self.index_version)
+        return hashlib.sha1(key.encode("utf-8")).digest()
+
+    def save_index(self, path):
+        """Saves the index of safe and unsafe samples to `path`."""
+        self._index.save(path, self._index_fingerprint)
+
+    def load_index(self, path):
+        """Loads an index saved with `save_index` by memory-mapping `path`.
+        Raises a `ValueError` if it was saved for a dataset with a different
+        length or `index_version`.
+        """
+        self._index = ValidityIndex.load(
+            path, len(self.dataset), self._index_fingerprint
+        )
+        self._failed_epochs = None
 
     def _reset_index(self):
         """Resets the safe and unsafe samples indices."""
-        self._safe_indices = self._unsafe_indices = []
+        self._index.reset()
+        self._failed_epochs = None
+        if self.cache is not None:
+            self.cache.clear()
 
     @property
     def is_index_built(self):
         """Returns True if all indices of the original dataset have been
-        classified into safe_samples_indices or _unsafe_samples_indices.
+        classified as either safe or unsafe.
         """
-        return len(self.dataset) == len(self._safe_indices) + len(self._unsafe_indices)
+        return self._index.is_complete
 
     @property
     def num_samples_examined(self):
-        return len(self._safe_indices) + len(self._unsafe_indices)
+        return self._index.num_examined
 
     def __len__(self):
         """Returns the length of the original dataset.
@@ -77,26 +379,371 @@ class SafeDataset(torch.utils.data.Dataset):
         return len(self.dataset)
 
     def __iter__(self):
+        """Iterates over the safe samples, loading each sample once and
+        skipping samples already known to be unsafe without loading them."""
+        if self.prefetch > 0:
+            return self._iter_prefetched(self.prefetch)
         return (
-            self._safe_get_item(i)
-            for i in range(len(self))
-            if self._safe_get_item(i) is not None
+            sample
+            for sample in map(self._safe_get_item, self._candidate_indices())
+            if sample is not None
+        )
+
+    def _candidate_indices(self, start=0, end=None):
+        """Yields every index in `range(start, end)` that may be loaded (see
+        `_next_candidate`), in order."""
+        end = len(self.dataset) if end is None else min(end, len(self.dataset))
+        idx = self._next_candidate(start)
+        while idx < end:
+            yield idx
+            idx = self._next_candidate(idx + 1)
+
+    def _next_candidate(self, idx):
+        """Returns the first index from `idx` onwards that may be loaded, or
+        `len(self)` if there is none.
+
+        Unless `retry_policy` may retry unsafe samples, that is the first
+        index not known to be unsafe, which is found in constant time.
+        Otherwise, it is `idx` itself, leaving the retry policy to be
+        consulted when the sample is loaded.
+        """
+        if isinstance(self.retry_policy, NeverRetry):
+            return self._index.next_candidate(idx)
+        return min(idx, len(self.dataset))
+
+    def _iter_prefetched(self, prefetch):
+        """Iterates over the safe samples while `prefetch` threads load the
+        samples that follow."""
+        executor = ThreadPoolExecutor(max_workers=prefetch)
+        indices = self._candidate_indices()
+        pending = collections.deque(
+            executor.submit(self._safe_get_item, idx)
+            for idx in itertools.islice(indices, prefetch)
         )
+        try:
+            while pending:
+                sample = pending.popleft().result()
+                for idx in itertools.islice(indices, 1):
+                    pending.append(executor.submit(self._safe_get_item, idx))
+                if sample is not None:
+                    yield sample
+        finally:
+            for future in pending:
+                future.cancel()
+            executor.shutdown(wait=False)
 
-    @memoize
     def __getitem__(self, idx):
         """Behaves like the standard __getitem__ for Dataset when the index
         has been built.
+
+        If the sample at `idx` is unsafe, the next safe sample is returned in
+        its place. Samples already known to be unsafe are skipped in constant
+        time, unless `retry_policy` allows them to be loaded again.
         """
-        while idx < len(self.dataset):
-            sample = self._safe_get_item(idx)
+        idx, sample = self._cached_sample(idx)
+        if sample is not None:
+            return sample
+        for candidate in self._candidate_indices(idx):
+            sample = self._safe_get_item(candidate)
             if sample is not None:
-                return sample
-            idx += 1
+                return self._cache_sample(idx, sample)
         raise IndexError
 
+    def _cached_sample(self, idx):
+        """Checks `idx` and returns it along with the sample cached for it,
+        or None if there is none."""
+        idx = self._check_index(idx)
+        sample = None if self.cache is None else self.cache.get(idx)
+        return idx, sample
+
+    def _cache_sample(self, idx, sample):
+        """Caches `sample` as the one served for `idx`, and returns it."""
+        if self.cache is not None:
+            self.cache.put(idx, sample)
+        return sample
+
     def __getattr__(self, key):
         """Delegates to original dataset object if an attribute is not
         found in this class.
         """
+        # `dataset` itself is missing while unpickling (e.g. in a spawned
+        # DataLoader worker), in which case delegating would recurse forever.
+        if key == "dataset":
+            raise AttributeError(key)
         return getattr(self.dataset, key)
+
+
+class SafeIterableDataset(getattr(torch.utils.data, "IterableDataset", object)):
+    """A wrapper around an iterable-style dataset (e.g. a
+    torch.utils.data.IterableDataset streaming samples from a source that
+    can't be indexed) that drops samples as they are streamed.
+
+    Samples that are None, that raise an error when the wrapped iterator is
+    advanced to them (if it can carry on afterwards), or that make
+    `transform` raise an error or return None are skipped. If advancing the
+    iterator fails `max_consecutive_errors` times in a row, it is assumed to
+    be broken for good (e.g. its file handle or connection is gone) and the
+    last error is raised.
+
+    Like any iterable-style dataset, it is iterated over in full by every
+    DataLoader worker, so unless `dataset` splits its samples between the
+    workers itself (through `torch.utils.data.get_worker_info()`), every
+    worker yields the same samples. Pass `shard=True` to have each of the
+    `num_workers` workers keep every `num_workers`-th sample it receives
+    instead. Every worker then still reads (and decodes, if the wrapped
+    dataset does) the whole stream; only the work of `transform` is split
+    between them, so expensive decoding is best left to `transform`. Don't
+    combine `shard=True` with a dataset that shards itself, which would only
+    leave each worker a `1 / num_workers` share of its own share.
+    """
+
+    def __init__(
+        self, dataset, transform=None, shard=False, max_consecutive_errors=100
+    ):
+        """Creates a `SafeIterableDataset` wrapper around `dataset`.
+
+        Arguments:
+            dataset (iterable): The dataset to be wrapped.
+            transform (callable, optional): Function applied to every sample
+                that is kept, after sharding. Since it is called on the
+                samples one at a time, it can fail on a sample (e.g. one that
+                doesn't decode) without ending the stream, unlike the wrapped
+                dataset's own iterator if it is a generator.
+            shard (bool, optional): If True, the samples streamed are split
+                between DataLoader workers, which is needed unless `dataset`
+                already splits them itself.
+            max_consecutive_errors (int, optional): The number of times in a
+                row the wrapped iterator may fail to produce a sample before
+                the last error is raised.
+        """
+        self.dataset = dataset
+        self.transform = transform
+        self.shard = shard
+        self.max_consecutive_errors = max_consecutive_errors
+
+    def __iter__(self):
+        num_shards, shard_id = 1, 0
+        worker_info = torch.utils.data.get_worker_info()
+        if self.shard and worker_info is not None:
+            num_shards, shard_id = worker_info.num_workers, worker_info.id
+
+        iterator = iter(self.dataset)
+        num_errors = 0
+        # The number of samples received from the stream so far, which the
+        # shards are split by.
+        position = -1
+        while True:
+            try:
+                sample = next(iterator)
+            except StopIteration:
+                return
+            except Exception:
+                num_errors += 1
+                if num_errors >= self.max_consecutive_errors:
+                    raise
+                continue
+            num_errors = 0
+            position += 1
+            if position % num_shards != shard_id or sample is None:
+                continue
+            if self.transform is not None:
+                try:
+                    sample = self.transform(sample)
+                except Exception:
+                    continue
+                if sample is None:
+                    continue
+            yield sample
+
+    def __getattr__(self, key):
+        """Delegates to original dataset object if an attribute is not
+        found in this class.
+        """
+        if key == "dataset":
+            raise AttributeError(key)
+        return getattr(self.dataset, key)
+
+
+class CompactSafeDataset(torch.utils.data.Dataset):
+    """A view of a `SafeDataset` containing only the samples found to be safe
+    when the view was created, so that its length is the number of safe
+    samples and `view[i]` is the `i`-th safe sample.
+
+    Unlike `SafeDataset` itself, it can be used with any sampler since it
+    never has to look beyond the requested index for a replacement, except
+    for samples that turn out to be unsafe after the view was created (e.g.
+    ones that passed an `is_valid` check but fail to load), which are
+    replaced by the next safe sample of the underlying dataset.
+    """
+
+    def __init__(self, safe_dataset):
+        self.safe_dataset = safe_dataset
+        # Maps positions in the view to indices over the original dataset.
+        self.indices = safe_dataset._index.safe_indices()
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, i):
+        idx = int(self.indices[i])
+        sample = self.safe_dataset._safe_get_item(idx)
+        if sample is None:
+            sample = self.safe_dataset[idx]
+        return sample
+
+
+class AsyncSafeDataset(SafeDataset):
+    """A `SafeDataset` over a dataset whose `__getitem__` is a coroutine
+    function (or otherwise returns awaitables), e.g. one fetching samples from
+    an object store.
+
+    Up to `max_concurrency` samples are fetched concurrently whenever several
+    are needed at once: when iterating over the dataset (with `for` or
+    `async for`), when a `SafeDataLoader` loads a batch, and when building
+    the index. Samples are classified as safe or unsafe just like they are by
+    `SafeDataset`.
+
+    From within a coroutine, use `aget_item` instead of indexing the dataset,
+    which runs the fetch on an event loop of its own and so can't be called
+    while another one is running in the same thread. An `is_valid` method on
+    the wrapped dataset, if any, must be a regular function.
+    """
+
+    def __init__(self, dataset, max_concurrency=16, **kwargs):
+        """Creates an `AsyncSafeDataset` wrapper around `dataset`.
+
+        Arguments:
+            dataset (Dataset): The dataset to be wrapped.
+            max_concurrency (int, optional): The maximum number of samples
+                being fetched at the same time by any one event loop.
+
+        All other keyword arguments are passed on to `SafeDataset`. If
+        `eager_eval` is an integer, the index is still built by fetching
+        samples concurrently in this process rather than by that many worker
+        processes, unless the wrapped dataset has an `is_valid` method.
+        """
+        assert max_concurrency > 0, "max_concurrency must be a positive integer."
+        self.max_concurrency = max_concurrency
+        self._init_event_loops()
+        super(AsyncSafeDataset, self).__init__(dataset, **kwargs)
+
+    def _init_event_loops(self):
+        # The event loop used by each thread for synchronous calls, which is
+        # replaced in forked processes.
+        self._local = threading.local()
+        # Every event loop created by _run, closed along with the dataset.
+        self._loops = []
+        weakref.finalize(self, _close_event_loops, self._loops)
+        # Limits the number of concurrent fetches on each event loop.
+        self._semaphores = weakref.WeakKeyDictionary()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_local"]
+        del state["_semaphores"]
+        del state["_loops"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_event_loops()
+
+    def _run(self, coroutine):
+        """Runs `coroutine` to completion on this thread's event loop."""
+        loop = getattr(self._local, "loop", None)
+        if loop is None or self._local.pid != os.getpid():
+            loop = self._local.loop = asyncio.new_event_loop()
+            self._local.pid = os.getpid()
+            self._loops.append(loop)
+        return loop.run_until_complete(coroutine)
+
+    def _semaphore(self):
+        loop = asyncio.get_running_loop()
+        semaphore = self._semaphores.get(loop)
+        if semaphore is None:
+            semaphore = self._semaphores[loop] = asyncio.Semaphore(self.max_concurrency)
+        return semaphore
+
+    async def _async_safe_get_item(self, idx, retry_checked=False):
+        """Coroutine version of `_safe_get_item`."""
+        idx = self._check_index(idx)
+        try:
+            if not retry_checked and self._is_known_unsafe(idx):
+                return None
+            async with self._semaphore():
+                sample = self.dataset[idx]
+                if inspect.isawaitable(sample):
+                    sample = await sample
+            return self._record_sample(idx, sample)
+        except Exception:
+            self._mark_unsafe(idx)
+            return None
+
+    async def _async_safe_get_items(self, indices):
+        return await asyncio.gather(
+            *[self._async_safe_get_item(idx) for idx in indices]
+        )
+
+    def _safe_get_item(self, idx, retry_checked=False):
+        return self._run(self._async_safe_get_item(idx, retry_checked))
+
+    def _safe_get_items(self, indices):
+        return self._run(self._async_safe_get_items(indices))
+
+    async def aget_item(self, idx):
+        """Coroutine version of `__getitem__`."""
+        idx, sample = self._cached_sample(idx)
+        if sample is not None:
+            return sample
+        for candidate in self._candidate_indices(idx):
+            sample = await self._async_safe_get_item(candidate)
+            if sample is not None:
+                return self._cache_sample(idx, sample)
+        raise IndexError
+
+    def _build_index(self, num_workers=0, chunk_size=1024):
+        if getattr(self.dataset, "is_valid", None) is not None:
+            return super(AsyncSafeDataset, self)._build_index(num_workers, chunk_size)
+        unknown = (
+            idx
+            for idx in range(len(self.dataset))
+            if self._index.state(idx) == ValidityIndex.UNKNOWN
+        )
+        while True:
+            chunk = list(itertools.islice(unknown, chunk_size))
+            if not chunk:
+                break
+            self._safe_get_items(chunk)
+
+    def __iter__(self):
+        """Iterates over the safe samples, fetching up to `max_concurrency`
+        samples at a time."""
+        indices = self._candidate_indices()
+        while True:
+            chunk = list(itertools.islice(indices, self.max_concurrency))
+            if not chunk:
+                return
+            for sample in self._safe_get_items(chunk):
+                if sample is not None:
+                    yield sample
+
+    async def __aiter__(self):
+        """Asynchronously iterates over the safe samples in order, keeping up
+        to `max_concurrency` fetches in flight."""
+        indices = self._candidate_indices()
+        pending = collections.deque(
+            asyncio.ensure_future(self._async_safe_get_item(idx))
+            for idx in itertools.islice(indices, self.max_concurrency)
+        )
+        try:
+            while pending:
+                sample = await pending.popleft()
+                for idx in itertools.islice(indices, 1):
+                    pending.append(
+                        asyncio.ensure_future(self._async_safe_get_item(idx))
+                    )
+                if sample is not None:
+                    yield sample
+        finally:
+            for future in pending:
+                future.cancel()
@@ -0,0 +1,384 @@
+import mmap
+import multiprocessing
+import os
+import struct
+import tempfile
+import threading
+import weakref
+from multiprocessing.context import get_spawning_popen
+
+import torch
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory = None
+
+
+def _release_shared_memory(shm, buffer, owner_pid):
+    buffer.release()
+    shm.close()
+    # Forked DataLoader workers inherit the owner's finalizer, so check that
+    # this really is the process that created the shared memory.
+    if os.getpid() == owner_pid:
+        shm.unlink()
+
+
+class ValidityIndex(object):
+    """A compact index recording which samples of a dataset are safe and
+    which are unsafe.
+
+    Every index is in one of three states - unknown, safe or unsafe - stored
+    as two bitmaps (one bit per sample each), so testing or updating the
+    state of an index is O(1) regardless of the size of the dataset.
+
+    The running counts and both bitmaps live in a single flat buffer laid out
+    as `[num_safe, num_unsafe | generation | safe bitmap | unsafe bitmap]`,
+    which keeps the whole index in one contiguous block of memory, which can
+    be saved to a file or moved into shared memory as is. `generation` counts
+    the times samples stopped being unsafe, which tells every process sharing
+    the index when the jumps it has recorded for `next_candidate` are stale.
+    """
+
+    UNKNOWN = 0
+    SAFE = 1
+    UNSAFE = 2
+
+    _counts = struct.Struct("<QQ")
+    _generation = struct.Struct("<Q")
+    # magic, number of samples, dataset fingerprint (padded to 8 bytes)
+    _file_header = struct.Struct("<8sQ20s4x")
+    _file_magic = b"NCINDEX2"
+
+    def __init__(self, length, buffer=None):
+        """Creates an index over `length` samples. If `buffer` is `None`, a
+        new zeroed buffer (all samples unknown) is allocated, otherwise
+        `buffer` must be a writable buffer of `ValidityIndex.nbytes(length)`
+        bytes holding a previously built index.
+        """
+        self.length = length
+        self._bitmap_nbytes = (length + 7) // 8
+        self._safe_offset = self._counts.size + self._generation.size
+        self._unsafe_offset = self._safe_offset + self._bitmap_nbytes
+        if buffer is None:
+            buffer = bytearray(ValidityIndex.nbytes(length))
+        elif len(buffer) != ValidityIndex.nbytes(length):
+            raise ValueError(
+                "buffer must be {} bytes long for an index over {} samples, "
+                "found {}".format(ValidityIndex.nbytes(length), length, len(buffer))
+            )
+        self._buffer = buffer
+        self._shm = None
+        # Guards updates against other threads, or against other processes
+        # once the index is shared.
+        self._lock = threading.Lock()
+        # Maps blocks of 64 samples that are all unsafe to a later block that
+        # the run of such blocks they belong to ends before, as of the
+        # generation the jumps were recorded in.
+        self._block_jumps = {}
+        self._jumps_generation = self._read_generation()
+
+    @staticmethod
+    def nbytes(length):
+        """Returns the size in bytes of the buffer backing an index over
+        `length` samples."""
+        return (
+            ValidityIndex._counts.size
+            + ValidityIndex._generation.size
+            + 2 * ((length + 7) // 8)
+        )
+
+    @property
+    def buffer(self):
+        return self._buffer
+
+    def save(self, path, fingerprint):
+        """Writes the index to `path`, tagged with `fingerprint` (a bytes
+        object of at most 20 bytes identifying the dataset it was built
+        over).
+
+        The file is written next to `path` first and then moved into place,
+        so that processes which have `path` memory-mapped are unaffected.
+        """
+        dirname = os.path.dirname(os.path.abspath(path))
+        fd, tmp_path = tempfile.mkstemp(dir=dirname, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                header = self._file_header.pack(
+                    self._file_magic, self.length, fingerprint
+                )
+                f.write(header)
+                f.write(self._buffer)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    @classmethod
+    def load(cls, path, length, fingerprint):
+        """Memory-maps the index saved at `path`, without reading it into
+        memory upfront.
+
+        The mapping is copy-on-write: samples classified after loading are
+        recorded in memory but only reach the file through `save`. Raises a
+        `ValueError` if the file was not saved over `length` samples with the
+        same `fingerprint`.
+        """
+        with open(path, "rb") as f:
+            header = f.read(cls._file_header.size)
+            if len(header) < cls._file_header.size:
+                raise ValueError("{} is not a nonechucks index file.".format(path))
+            magic, saved_length, saved_fingerprint = cls._file_header.unpack(header)
+            if magic != cls._file_magic:
+                raise ValueError("{} is not a nonechucks index file.".format(path))
+            fingerprint = fingerprint.ljust(20, b"\0")
+            if saved_length != length or saved_fingerprint != fingerprint:
+                raise ValueError(
+                    "{} was saved for a different dataset (fingerprint "
+                    "mismatch).".format(path)
+                )
+            mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        buffer = memoryview(mapping)[cls._file_header.size :]
+        return cls(length, buffer=buffer)
+
+    def share_memory_(self):
+        """Moves the index into shared memory, so that every process it is
+        sent to (e.g. DataLoader workers) reads and updates the same index as
+        this one. Returns the index itself.
+        """
+        if self._shm is not None:
+            return self
+        if shared_memory is None:
+            raise RuntimeError("Sharing an index requires Python 3.8 or later.")
+        nbytes = len(self._buffer)
+        shm = shared_memory.SharedMemory(create=True, size=nbytes)
+        buffer = shm.buf[:nbytes]
+        buffer[:] = self._buffer
+        self._attach(shm, buffer, owner_pid=os.getpid())
+        # A lock created in a spawn context can be shared with workers started
+        # by any method, unlike one created in a fork context.
+        self._lock = multiprocessing.get_context("spawn").Lock()
+        return self
+
+    @property
+    def is_shared(self):
+        return self._shm is not None
+
+    def _attach(self, shm, buffer, owner_pid=None):
+        self._shm = shm
+        self._buffer = buffer
+        weakref.finalize(self, _release_shared_memory, shm, buffer, owner_pid)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if self._shm is not None and get_spawning_popen() is not None:
+            # Processes being started with a shared index (e.g. DataLoader
+            # workers) attach to the same block of shared memory, and share
+            # its lock.
+            state["_shm"] = self._shm.name
+            state["_buffer"] = None
+        else:
+            # Otherwise (e.g. when saving or copying the index), and for
+            # memory-mapped buffers, which can't be pickled, a copy of the
+            # index is made instead.
+            state["_shm"] = None
+            state["_buffer"] = bytearray(self._buffer)
+            state["_lock"] = None
+        return state
+
+    def __setstate__(self, state):
+        shm_name = state.pop("_shm", None)
+        self.__dict__.update(state)
+        self._shm = None
+        if self._lock is None:
+            self._lock = threading.Lock()
+        if shm_name is not None:
+            shm = shared_memory.SharedMemory(name=shm_name)
+            self._attach(shm, shm.buf[: ValidityIndex.nbytes(self.length)])
+
+    def __len__(self):
+        return self.length
+
+    def is_safe(self, idx):
+        return bool(self._buffer[self._safe_offset + (idx >> 3)] & (1 << (idx & 7)))
+
+    def is_unsafe(self, idx):
+        return bool(self._buffer[self._unsafe_offset + (idx >> 3)] & (1 << (idx & 7)))
+
+    def state(self, idx):
+        """Returns one of `UNKNOWN`, `SAFE` or `UNSAFE` for `idx`."""
+        if self.is_safe(idx):
+            return ValidityIndex.SAFE
+        if self.is_unsafe(idx):
+            return ValidityIndex.UNSAFE
+        return ValidityIndex.UNKNOWN
+
+    def mark_safe(self, idx):
+        self._mark(idx, self._safe_offset, self._unsafe_offset, 0)
+
+    def mark_unsafe(self, idx):
+        self._mark(idx, self._unsafe_offset, self._safe_offset, 1)
+
+    def _mark(self, idx, set_offset, clear_offset, count_slot):
+        """Sets the bit of `idx` in the bitmap at `set_offset`, clearing it in
+        the one at `clear_offset`, and updates the counts accordingly."""
+        byte, mask = idx >> 3, 1 << (idx & 7)
+        buffer = self._buffer
+        if buffer[set_offset + byte] & mask:
+            return
+        with self._lock:
+            # Another process sharing the index may have got here first.
+            if buffer[set_offset + byte] & mask:
+                return
+            counts = list(self._counts.unpack_from(buffer))
+            buffer[set_offset + byte] |= mask
+            counts[count_slot] += 1
+            if buffer[clear_offset + byte] & mask:
+                buffer[clear_offset + byte] &= ~mask & 0xFF
+                counts[1 - count_slot] -= 1
+                if clear_offset == self._unsafe_offset:
+                    # Jumps may now skip over a sample that is no longer
+                    # unsafe, in this process and in any other sharing the
+                    # index.
+                    self._generation.pack_into(
+                        buffer, self._counts.size, self._read_generation() + 1
+                    )
+            self._counts.pack_into(buffer, 0, *counts)
+
+    def safe_indices(self):
+        """Returns the indices of all samples marked safe, in increasing
+        order, as an int64 tensor."""
+        return self._bits(self._safe_offset).nonzero().flatten()
+
+    def candidate_indices(self):
+        """Returns the indices of all samples not marked unsafe (i.e. the safe
+        samples and the ones yet to be examined), in increasing order, as an
+        int64 tensor."""
+        return (self._bits(self._unsafe_offset) == 0).nonzero().flatten()
+
+    def _bits(self, offset):
+        """Unpacks the bitmap at `offset` into a uint8 tensor holding one 0 or
+        1 per sample."""
+        bitmap = bytearray(self._buffer[offset : offset + self._bitmap_nbytes])
+        if hasattr(torch, "frombuffer"):
+            packed = torch.frombuffer(bitmap, dtype=torch.uint8)
+        else:  # PyTorch < 1.10
+            packed = torch.tensor(bitmap, dtype=torch.uint8)
+        shifts = torch.arange(8, dtype=torch.uint8)
+        return ((packed.unsqueeze(1) >> shifts) & 1).flatten()[: self.length]
+
+    def next_candidate(self, idx):
+        """Returns the first index from `idx` onwards that isn't known to be
+        unsafe, or `len(self)` if there is none.
+
+        The unsafe bitmap is examined a block of 64 samples at a time, and
+        runs of blocks that are entirely unsafe are skipped in one step using
+        jumps recorded (and shortcut) as they are found, so the lookup takes
+        constant amortized time however long the run of unsafe samples is.
+        """
+        while idx < self.length:
+            offset = idx & 63
+            word = self._unsafe_word(idx >> 6) >> offset
+            # Position of the lowest zero bit, i.e. the first sample that
+            # isn't unsafe.
+            first_zero = (~word & (word + 1)).bit_length() - 1
+            if offset + first_zero < 64:
+                return min(idx + first_zero, self.length)
+            idx = self._next_block(idx >> 6) << 6
+        return self.length
+
+    def _unsafe_word(self, block):
+        start = self._unsafe_offset + (block << 3)
+        return int.from_bytes(
+            self._buffer[start : min(start + 8, len(self._buffer))], "little"
+        )
+
+    def _next_block(self, block):
+        """Returns the first block after `block` that isn't entirely unsafe,
+        recording a jump to it from every block passed along the way."""
+        generation = self._read_generation()
+        if generation != self._jumps_generation:
+            self._block_jumps = {}
+            self._jumps_generation = generation
+        num_blocks = (self.length + 63) >> 6
+        passed = []
+        block += 1
+        while block < num_blocks:
+            jump = self._block_jumps.get(block)
+            if jump is not None:
+                passed.append(block)
+                block = jump
+            elif self._unsafe_word(block) == 0xFFFFFFFFFFFFFFFF:
+                passed.append(block)
+                block += 1
+            else:
+                break
+        for passed_block in passed:
+            self._block_jumps[passed_block] = block
+        return block
+
+    def _read_generation(self):
+        return self._generation.unpack_from(self._buffer, self._counts.size)[0]
+
+    @property
+    def num_safe(self):
+        return self._counts.unpack_from(self._buffer)[0]
+
+    @property
+    def num_unsafe(self):
+        return self._counts.unpack_from(self._buffer)[1]
+
+    @property
+    def num_examined(self):
+        """Number of indices classified as either safe or unsafe."""
+        return sum(self._counts.unpack_from(self._buffer))
+
+    @property
+    def is_complete(self):
+        """Returns True if every index has been classified."""
+        return self.num_examined == self.length
+
+    def merge(self, other, start):
+        """Copies the classification of the samples in `other`, an index over
+        the samples `start, start + 1, ..., start + len(other) - 1` of this
+        one, without overwriting samples that are already classified here.
+        `start` must be a multiple of 8.
+        """
+        assert start % 8 == 0, "start must be a multiple of 8."
+        begin, end = start >> 3, (start >> 3) + other._bitmap_nbytes
+
+        def read(index, offset, begin, end):
+            return int.from_bytes(
+                bytes(index._buffer[offset + begin : offset + end]), "little"
+            )
+
+        with self._lock:
+            safe = read(self, self._safe_offset, begin, end)
+            unsafe = read(self, self._unsafe_offset, begin, end)
+            other_safe = read(other, other._safe_offset, 0, end - begin)
+            other_unsafe = read(other, other._unsafe_offset, 0, end - begin)
+            unknown = ~(safe | unsafe)
+            new_safe = other_safe & unknown
+            new_unsafe = other_unsafe & unknown & ~new_safe
+
+            nbytes = end - begin
+            self._buffer[self._safe_offset + begin : self._safe_offset + end] = (
+                safe | new_safe
+            ).to_bytes(nbytes, "little")
+            self._buffer[self._unsafe_offset + begin : self._unsafe_offset + end] = (
+                unsafe | new_unsafe
+            ).to_bytes(nbytes, "little")
+            num_safe, num_unsafe = self._counts.unpack_from(self._buffer)
+            self._counts.pack_into(
+                self._buffer,
+                0,
+                num_safe + bin(new_safe).count("1"),
+                num_unsafe + bin(new_unsafe).count("1"),
+            )
+
+    def reset(self):
+        """Marks every index as unknown."""
+        with self._lock:
+            generation = self._read_generation()
+            self._buffer[:] = bytes(len(self._buffer))
+            self._generation.pack_into(self._buffer, self._counts.size, generation + 1)
@@ -0,0 +1,63 @@
+import random
+
+
+class RetryPolicy(object):
+    """Decides whether a sample that has previously been found to be unsafe
+    should be loaded again, or simply dropped without touching the wrapped
+    dataset.
+
+    A policy is consulted once per access to an unsafe sample. Policies whose
+    decisions only depend on their arguments set `deterministic` to True,
+    which lets samplers rule out the samples they won't retry ahead of the
+    load, since consulting them again when loading gives the same answer.
+    Policies that don't look at `failed_epoch` set `uses_failed_epoch` to
+    False, which spares the dataset from recording the epoch every unsafe
+    sample failed in.
+    """
+
+    deterministic = False
+    uses_failed_epoch = True
+
+    def should_retry(self, idx, epoch, failed_epoch):
+        """Returns True if the unsafe sample at `idx`, which last failed in
+        epoch `failed_epoch`, should be loaded again in epoch `epoch`."""
+        raise NotImplementedError
+
+
+class NeverRetry(RetryPolicy):
+    """Never loads a sample again once it has been found to be unsafe."""
+
+    deterministic = True
+    uses_failed_epoch = False
+
+    def should_retry(self, idx, epoch, failed_epoch):
+        return False
+
+
+class RetryEveryNEpochs(RetryPolicy):
+    """Loads an unsafe sample again once `n` epochs have passed since it last
+    failed."""
+
+    deterministic = True
+
+    def __init__(self, n):
+        assert n > 0, "n must be a positive integer."
+        self.n = n
+
+    def should_retry(self, idx, epoch, failed_epoch):
+        return epoch - failed_epoch >= self.n
+
+
+class RetryWithProbability(RetryPolicy):
+    """Loads an unsafe sample again with probability `p` every time it is
+    accessed."""
+
+    uses_failed_epoch = False
+
+    def __init__(self, p, seed=None):
+        assert 0 <= p <= 1, "p must lie in [0, 1]."
+        self.p = p
+        self._rng = random.Random(seed)
+
+    def should_retry(self, idx, epoch, failed_epoch):
+        return self._rng.random() < self.p
@@ -1,7 +1,47 @@
+import collections
+
 import torch
+import torch.distributed as dist
 import torch.utils.data
 
 from nonechucks.dataset import SafeDataset
+from nonechucks.retry import NeverRetry
+
+
+class _SamplerWindow(object):
+    """A view of the indices returned by a sampler that pulls them from the
+    sampler as they are asked for and only keeps the last `size` of them, so
+    that `view[i]` is the `i`-th index returned by the sampler as long as it
+    isn't more than `size` indices behind the furthest one asked for so far.
+    """
+
+    def __init__(self, sampler, size):
+        self._iterator = iter(sampler)
+        self._indices = collections.deque(maxlen=size)
+        # Position of self._indices[0] among the indices of the sampler.
+        self._start = 0
+
+    def __getitem__(self, position):
+        """Returns the index at `position`, raising an `IndexError` if the
+        sampler runs out of indices before it."""
+        if position < 0:
+            raise ValueError("Positions can't be negative.")
+        if position < self._start:
+            raise ValueError(
+                "Position {} is more than {} samples behind the furthest one "
+                "sampled; use a larger window_size.".format(
+                    position, self._indices.maxlen
+                )
+            )
+        while position >= self._start + len(self._indices):
+            try:
+                idx = next(self._iterator)
+            except StopIteration:
+                raise IndexError
+            if len(self._indices) == self._indices.maxlen:
+                self._start += 1
+            self._indices.append(idx)
+        return self._indices[position - self._start]
 
 
 class SafeSampler(torch.utils.data.sampler.Sampler):
@@ -14,7 +54,14 @@ class SafeSampler(torch.utils.data.sampler.Sampler):
     def default_step_to_index_fn(original_idx, actual_idx):
         return actual_idx
 
-    def __init__(self, dataset, sampler=None, step_to_index_fn=None):
+    def __init__(
+        self,
+        dataset,
+        sampler=None,
+        step_to_index_fn=None,
+        defer_validation=False,
+        window_size=1024,
+    ):
         """Create a `SafeSampler` instance that performs sampling over either
         another sampler object or directly over a dataset. `step_to_index_fn`
         will define the `SafeSampler` instance's behavior when it encounters
@@ -30,16 +77,28 @@ class SafeSampler(torch.utils.data.sampler.Sampler):
             dataset (SafeDataset): The dataset to be sampled.
             sampler (Sampler, optional): If `sampler` is `None`, the sampling
                 is performed directly over the `dataset`, otherwise it's done
-                over the list of indices returned by `sampler`'s `__iter__`
-                method.
+                over the sequence of indices returned by `sampler`'s
+                `__iter__` method, which are pulled from it as needed.
                 If `sampler` takes a `Dataset` object as a parameter,
                 `dataset` should ideally be the same as the one passed to
                 `sampler`.
             step_to_index_fn (function, optional): Function that takes in 2
                 arguments - (`num_valid_samples` and `num_samples_examined`),
-                and returns the next index to be sampled. If None or not
+                and returns the position (in the sequence of indices returned
+                by `sampler`) of the next index to be sampled. If None or not
                 specified, the default function returns the
-                `num_samples_examined` as the output.
+                `num_samples_examined` as the output. Positions may not be
+                negative, nor lie more than `window_size` positions behind
+                the furthest one returned so far.
+            defer_validation (bool, optional): If True, samples are never
+                loaded just to check their validity. Indices already known to
+                be unsafe (or that fail the dataset's `is_valid` check) are
+                skipped, and all other indices are returned as is, leaving it
+                to whoever loads them (e.g. `SafeDataLoader`'s workers) to
+                drop the ones that turn out to be unsafe.
+            window_size (int, optional): The number of indices most recently
+                pulled from `sampler` that are kept for `step_to_index_fn` to
+                go back to.
         """
         assert isinstance(
             dataset, SafeDataset
@@ -53,14 +112,18 @@ class SafeSampler(torch.utils.data.sampler.Sampler):
         if step_to_index_fn is None:
             step_to_index_fn = SafeSampler.default_step_to_index_fn
         self.step_to_index_fn = step_to_index_fn
+        self.defer_validation = defer_validation
+        self.window_size = window_size
 
     def __iter__(self):
         """Return iterator over sampled indices."""
         if self.sampler is not None:
-            self.sampler_indices = list(iter(self.sampler))
+            self.sampler_indices = _SamplerWindow(self.sampler, self.window_size)
 
         self.num_valid_samples = self.num_samples_examined = 0
-        return self
+        # A fresh iterator is returned every time since callers such as
+        # PyTorch 2.x's BatchSampler call iter() on whatever they're given.
+        return self._iter_indices()
 
     def _get_next_index(self):
         """Helper function that calls `step_to_index_fn` and decides
@@ -70,17 +133,285 @@ class SafeSampler(torch.utils.data.sampler.Sampler):
             index = self.sampler_indices[index]
         return index
 
-    def __next__(self):
-        """Returns next index to sample over `dataset`."""
+    def _iter_indices(self):
+        """Yields the next index to sample over `dataset` until there are
+        none left."""
         while True:
             try:
                 index = self._get_next_index()
-                self.num_samples_examined += 1
-                if self.dataset._safe_get_item(index) is not None:
-                    self.num_valid_samples += 1
-                    return index
             except IndexError:
-                raise StopIteration
+                return
+            self.num_samples_examined += 1
+            if self.dataset._probe_item(index, load=not self.defer_validation):
+                self.num_valid_samples += 1
+                yield index
+
+
+class SafeRandomSampler(torch.utils.data.sampler.Sampler):
+    """Samples the indices of a `SafeDataset` in random order, leaving out the
+    samples already known to be unsafe unless the dataset's retry policy
+    allows them to be loaded again.
+
+    The order is drawn with a single `torch.randperm` at the start of every
+    epoch, over the indices not marked unsafe in the dataset's index if
+    unsafe samples are never retried, so that the cost of shuffling doesn't
+    depend on how the dataset is classified.
+    """
+
+    def __init__(self, dataset, generator=None, defer_validation=False):
+        """Creates a `SafeRandomSampler` over `dataset`.
+
+        Arguments:
+            dataset (SafeDataset): The dataset to be sampled.
+            generator (Generator, optional): Generator used to draw the
+                order.
+            defer_validation (bool, optional): If True, samples yet to be
+                examined are returned without loading them to check their
+                validity (see `SafeSampler`).
+        """
+        assert isinstance(
+            dataset, SafeDataset
+        ), "dataset must be an instance of SafeDataset."
+        self.dataset = dataset
+        self.generator = generator
+        self.defer_validation = defer_validation
+
+    def _candidate_indices(self):
+        """Returns the indices that may be sampled as an int64 tensor."""
+        if isinstance(self.dataset.retry_policy, NeverRetry):
+            return self.dataset._index.candidate_indices()
+        # Unsafe samples may be retried, which the policy is asked about (once)
+        # as they come up.
+        return torch.arange(len(self.dataset))
+
+    def __iter__(self):
+        candidates = self._candidate_indices()
+        if self.generator is None:
+            order = torch.randperm(len(candidates))
+        else:
+            order = torch.randperm(len(candidates), generator=self.generator)
+        for chunk in candidates[order].split(4096):
+            for index in chunk.tolist():
+                if self.dataset._probe_item(index, load=not self.defer_validation):
+                    yield index
+
+    def __len__(self):
+        """Returns the number of samples not marked unsafe, which the number
+        of indices sampled differs from as samples are examined (or retried)
+        along the way."""
+        return len(self.dataset) - self.dataset._index.num_unsafe
+
+
+class DistributedSafeSampler(torch.utils.data.sampler.Sampler):
+    """Splits the samples of a `SafeDataset` between the processes of a
+    distributed job, like `DistributedSampler`, while making sure that every
+    process yields the same number of full batches of safe samples per
+    epoch, so that none of them runs out of data before the others.
+
+    Every epoch, each process examines the samples of its share of the
+    dataset, and the processes exchange the safe indices they found through
+    an `all_gather` in `torch.distributed`. The safe indices of all the
+    processes are then dealt out between them in turn, as many to each as
+    make up whole batches, so that fewer than `num_replicas * batch_size`
+    safe samples are left out of the epoch. Samples that pass this check but
+    then fail to load in the DataLoader can still leave a process short.
+
+    Samples are examined by going by the dataset's index wherever it can,
+    and otherwise by the wrapped dataset's `is_valid` method if it has one.
+    Failing both, they are loaded one after the other in the main process,
+    which is slow for large datasets: build the index beforehand (e.g. with
+    `eager_eval`, or by loading it from `index_path`), or give the dataset an
+    `is_valid` method.
+
+    The indices are computed (collectively, so all processes must make the
+    call) by the first call to `__iter__` or `__len__` after `set_epoch`
+    changes the epoch, and reused until it changes again. Like with
+    `DistributedSampler`, `set_epoch` must be called at the start of every
+    epoch for the order (and the safe samples) to change.
+    If `torch.distributed` hasn't been initialized (which requires passing
+    `num_replicas` and `rank`), nothing is exchanged and each process yields
+    the safe indices of its own share, rounded down to whole batches.
+    """
+
+    def __init__(
+        self,
+        dataset,
+        batch_size=1,
+        num_replicas=None,
+        rank=None,
+        shuffle=True,
+        seed=0,
+        group=None,
+    ):
+        """Creates a `DistributedSafeSampler` over `dataset`.
+
+        Arguments:
+            dataset (SafeDataset): The dataset to be sampled.
+            batch_size (int, optional): The batch size of the DataLoader, so
+                that every process yields only full batches.
+            num_replicas (int, optional): The number of processes taking part
+                in the job. Defaults to the world size of `group`.
+            rank (int, optional): The rank of the current process within
+                `group`. Defaults to the rank of this process.
+            shuffle (bool, optional): If True, the dataset is shuffled (in the
+                same way by every process) before it is split.
+            seed (int, optional): Seed of the shuffle, which must be the same
+                in every process. The order also depends on the epoch set with
+                `set_epoch`.
+            group (ProcessGroup, optional): Process group the safe indices
+                are exchanged over, which must support CPU tensors
+                (e.g. one created with `backend="gloo"`). Defaults to the
+                default process group.
+        """
+        assert isinstance(
+            dataset, SafeDataset
+        ), "dataset must be an instance of SafeDataset."
+        if num_replicas is None:
+            num_replicas = dist.get_world_size(group)
+        if rank is None:
+            rank = dist.get_rank(group)
+        assert 0 <= rank < num_replicas, "rank must lie in [0, num_replicas)."
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.shuffle = shuffle
+        self.seed = seed
+        self.group = group
+        self.epoch = 0
+        # The epoch the indices in self._indices were computed for.
+        self._indices_epoch = None
+        self._indices = None
+
+    def set_epoch(self, epoch):
+        """Sets the epoch, which changes the order of the samples if `shuffle`
+        is True."""
+        self.epoch = epoch
+
+    def _shard(self):
+        """Returns the indices of this process's share of the dataset, as an
+        int64 tensor."""
+        if self.shuffle:
+            generator = torch.Generator()
+            generator.manual_seed(self.seed + self.epoch)
+            indices = torch.randperm(len(self.dataset), generator=generator)
+        else:
+            indices = torch.arange(len(self.dataset))
+        return indices[self.rank :: self.num_replicas]
+
+    def _compute_indices(self):
+        safe = [idx for idx in self._shard().tolist() if self.dataset._probe_item(idx)]
+        if self.num_replicas > 1 and dist.is_available() and dist.is_initialized():
+            union = self._gather_safe_indices(safe)
+            num_samples = (
+                len(union) // (self.num_replicas * self.batch_size) * self.batch_size
+            )
+            return union[self.rank :: self.num_replicas][:num_samples]
+        num_samples = len(safe) // self.batch_size * self.batch_size
+        return safe[:num_samples]
+
+    def _gather_safe_indices(self, safe):
+        """Returns the safe indices found by all the processes, given those
+        found by this one, taking one from each process in turn."""
+        size = torch.tensor([len(safe)], dtype=torch.int64)
+        sizes = [torch.zeros_like(size) for _ in range(self.num_replicas)]
+        dist.all_gather(sizes, size, group=self.group)
+        # all_gather needs tensors of the same size, so shorter lists are
+        # padded with -1.
+        max_size = int(max(sizes))
+        padded = torch.full((max_size,), -1, dtype=torch.int64)
+        padded[: len(safe)] = torch.tensor(safe, dtype=torch.int64)
+        gathered = [torch.empty_like(padded) for _ in range(self.num_replicas)]
+        dist.all_gather(gathered, padded, group=self.group)
+        union = torch.stack(gathered).t().flatten()
+        return union[union >= 0].tolist()
+
+    def _epoch_indices(self):
+        if self._indices_epoch != self.epoch:
+            self._indices = self._compute_indices()
+            self._indices_epoch = self.epoch
+        return self._indices
+
+    def __iter__(self):
+        return iter(self._epoch_indices())
+
+    def __len__(self):
+        return len(self._epoch_indices())
+
+
+class SafeBatchSampler(torch.utils.data.sampler.BatchSampler):
+    """A `BatchSampler` over a `SafeDataset` that leaves the indices known to
+    be unsafe out of its batches, so that they are made up of safe samples
+    only and come back from the DataLoader's workers full.
+
+    Whether an index is safe is decided without loading the sample: by the
+    dataset's index if the sample has already been examined (e.g. after
+    `_build_index`), and by the wrapped dataset's `is_valid` method otherwise.
+    When neither applies the index is kept, and a batch it turns out to be
+    unsafe in is filled in by `SafeDataLoader` as usual.
+    """
+
+    def __init__(
+        self,
+        dataset,
+        batch_size,
+        sampler=None,
+        shuffle=False,
+        generator=None,
+        drop_last=False,
+    ):
+        """Creates a `SafeBatchSampler` over `dataset`.
+
+        Arguments:
+            dataset (SafeDataset): The dataset to be sampled.
+            batch_size (int): The number of indices in each batch.
+            sampler (Sampler, optional): The sampler the indices are drawn
+                from. It shouldn't load samples to validate them itself (as
+                `SafeSampler` and `SafeRandomSampler` do unless
+                `defer_validation` is set), since the DataLoader then loads
+                them a second time. If None, the indices of `dataset` are
+                drawn in order, or shuffled if `shuffle` is True.
+            shuffle (bool, optional): If True, the indices are drawn in random
+                order by a `SafeRandomSampler` that doesn't load samples.
+                Cannot be combined with `sampler`.
+            generator (Generator, optional): Generator used to shuffle the
+                indices if `shuffle` is True.
+            drop_last (bool, optional): If True, the last batch is dropped if
+                it's incomplete.
+        """
+        assert isinstance(
+            dataset, SafeDataset
+        ), "dataset must be an instance of SafeDataset."
+        assert (
+            sampler is None or not shuffle
+        ), "shuffle cannot be combined with sampler."
+        if shuffle:
+            sampler = SafeRandomSampler(
+                dataset, generator=generator, defer_validation=True
+            )
+        elif sampler is None:
+            sampler = torch.utils.data.sampler.SequentialSampler(dataset)
+        super(SafeBatchSampler, self).__init__(sampler, batch_size, drop_last)
+        self.dataset = dataset
+
+    def __iter__(self):
+        batch = []
+        for idx in self.sampler:
+            if self.dataset._probe_item(idx, load=False):
+                batch.append(idx)
+                if len(batch) == self.batch_size:
+                    yield batch
+                    batch = []
+        if batch and not self.drop_last:
+            yield batch
 
-    # For Python2 compatibility
-    next = __next__
+    def __len__(self):
+        """Returns the number of batches the indices not marked unsafe make up,
+        which the number of batches sampled falls short of as more samples
+        are found to be unsafe."""
+        num_samples = min(
+            len(self.sampler), len(self.dataset) - self.dataset._index.num_unsafe
+        )
+        if self.drop_last:
+            return num_samples // self.batch_size
+        return (num_samples + self.batch_size - 1) // self.batch_size
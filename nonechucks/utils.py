@@ -1,7 +1,4 @@
-import collections
-
 from itertools import chain
-from functools import partial
 
 import torch
 
@@ -9,81 +6,204 @@ try:
     from torch.utils.data.dataloader import default_collate
 except ImportError:
     from torch.utils.data._utils.collate import default_collate
-from torch._six import string_classes
-
-
-class memoize(object):
-    """cache the return value of a method
 
-    This class is meant to be used as a decorator of methods. The return value
-    from a given method invocation will be cached on the instance whose method
-    was invoked. All arguments passed to a method decorated with memoize must
-    be hashable.
+try:
+    from torch._six import string_classes
+except ImportError:  # PyTorch 2.x
+    string_classes = (str, bytes)
 
-    If a memoized method is invoked directly on its class the result will not
-    be cached. Instead the method will be invoked like a static method:
-    class Obj(object):
-        @memoize
-        def add_to(self, arg):
-            return self + arg
-    Obj.add_to(1) # not enough arguments
-    Obj.add_to(1, 2) # returns 3, result is not cached
-    """
+try:
+    from collections.abc import Mapping, Sequence
+except ImportError:
+    from collections import Mapping, Sequence
 
-    def __init__(self, func):
-        self.func = func
 
-    def __get__(self, obj, objtype=None):
-        if obj is None:
-            return self.func
-        return partial(self, obj)
+def collate_batches(batches, collate_fn=default_collate):
+    """Collate multiple batches.
 
-    def __call__(self, *args, **kw):
-        obj = args[0]
-        try:
-            cache = obj.__cache
-        except AttributeError:
-            cache = obj.__cache = {}
-        key = (self.func, args[1:], frozenset(kw.items()))
+    Kept for backwards compatibility; equivalent to `concat_batches`
+    (`collate_fn` is ignored).
+    """
+    return concat_batches(batches)
+
+
+# Collated batches are trees whose inner nodes are dicts and sequences of
+# fields (tuples, namedtuples and lists), and whose leaves hold the values of
+# one field for the whole batch: tensors, lists of strings (which
+# default_collate leaves as is) or any other sliceable sequence. A batch is
+# flattened into a list of leaves and a spec, which is None for a leaf and a
+# (type, keys, child specs) tuple for an inner node, `keys` being None for
+# sequences.
+
+
+def _is_leaf(batch):
+    if isinstance(batch, torch.Tensor):
+        return True
+    if isinstance(batch, Mapping):
+        return False
+    if isinstance(batch, Sequence) and not isinstance(batch, string_classes):
+        return len(batch) == 0 or isinstance(batch[0], string_classes)
+    return True
+
+
+def _flatten(batch, leaves):
+    if _is_leaf(batch):
+        leaves.append(batch)
+        return None
+    if isinstance(batch, Mapping):
+        keys = list(batch)
+        children = [_flatten(batch[key], leaves) for key in keys]
+        return (type(batch), keys, children)
+    return (type(batch), None, [_flatten(field, leaves) for field in batch])
+
+
+def _unflatten(leaves, spec):
+    if spec is None:
+        return next(leaves)
+    batch_type, keys, children = spec
+    values = [_unflatten(leaves, child) for child in children]
+    if keys is not None:
         try:
-            res = cache[key]
-        except KeyError:
-            res = cache[key] = self.func(*args, **kw)
-        return res
+            return batch_type(zip(keys, values))
+        except TypeError:
+            return dict(zip(keys, values))
+    if hasattr(batch_type, "_fields"):  # namedtuple
+        return batch_type(*values)
+    try:
+        return batch_type(values)
+    except TypeError:
+        return values
+
+
+def flatten_batch(batch):
+    """Returns the leaves of `batch` in a fixed order, along with a spec from
+    which `unflatten_batch` rebuilds a batch of the same structure."""
+    leaves = []
+    spec = _flatten(batch, leaves)
+    return leaves, spec
+
+
+def unflatten_batch(leaves, spec):
+    """Inverse of `flatten_batch`."""
+    return _unflatten(iter(leaves), spec)
+
+
+def _concat_leaves(leaves, pin_memory=False, pin_memory_device=None):
+    first = leaves[0]
+    if isinstance(first, torch.Tensor):
+        if not pin_memory:
+            return torch.cat(leaves)
+        shape = (sum(len(leaf) for leaf in leaves),) + tuple(first.shape[1:])
+        if pin_memory_device in (None, "", "cuda"):
+            out = torch.empty(shape, dtype=first.dtype, pin_memory=True)
+        else:
+            out = torch.empty(shape, dtype=first.dtype).pin_memory(pin_memory_device)
+        return torch.cat(leaves, out=out)
+    if isinstance(first, Sequence):
+        return list(chain(*leaves))
+    raise TypeError(
+        "batches must be made up of tensors and sequences; found {}".format(type(first))
+    )
+
+
+def concat_batches(batches, pin_memory=False, pin_memory_device=None):
+    """Concatenates collated batches along the batch dimension.
+
+    Batches may be arbitrarily nested dicts, tuples, namedtuples and lists
+    (all with the same structure), which are walked once; each of their
+    leaves is concatenated with a single `torch.cat` (or joined, for lists of
+    strings) and the result has the same structure as the batches.
+
+    If `pin_memory` is True, the tensors of the result are allocated in
+    memory pinned for `pin_memory_device` (CUDA by default), unless `batches`
+    holds a single batch, which is returned as is.
+    """
+    first = batches[0]
+    if len(batches) == 1:
+        return first
+    leaves, spec = flatten_batch(first)
+    columns = [[leaf] for leaf in leaves]
+    for batch in batches[1:]:
+        batch_leaves, batch_spec = flatten_batch(batch)
+        if batch_spec != spec:
+            raise ValueError("batches must all have the same structure.")
+        for column, leaf in zip(columns, batch_leaves):
+            column.append(leaf)
+    return unflatten_batch(
+        [_concat_leaves(column, pin_memory, pin_memory_device) for column in columns],
+        spec,
+    )
+
+
+class BatchSchema(object):
+    """The structure of a collated batch, inferred once from an example batch
+    and reused to take apart (and put back together) batches of the same
+    structure without rediscovering it.
+
+    `flatten` raises a `ValueError` for batches whose structure differs from
+    the example's, in which case a new schema has to be inferred.
+    """
 
+    def __init__(self, batch):
+        leaves, self.spec = flatten_batch(batch)
+        self.leaf_types = [type(leaf) for leaf in leaves]
 
-def collate_batches(batches, collate_fn=default_collate):
-    """Collate multiple batches."""
-    error_msg = "batches must be tensors, dicts, or lists; found {}"
-    if isinstance(batches[0], torch.Tensor):
-        return torch.cat(batches, 0)
-    elif isinstance(batches[0], collections.Sequence):
-        return list(chain(*batches))
-    elif isinstance(batches[0], collections.Mapping):
-        return {key: default_collate([d[key] for d in batches]) for key in batches[0]}
-    raise TypeError((error_msg.format(type(batches[0]))))
+    def flatten(self, batch):
+        """Returns the leaves of `batch`, in the same order as
+        `flatten_batch`."""
+        leaves = []
+        try:
+            self._flatten(self.spec, batch, leaves)
+        except (KeyError, IndexError, TypeError):
+            raise ValueError("batch doesn't match the schema.")
+        for leaf, leaf_type in zip(leaves, self.leaf_types):
+            if type(leaf) is not leaf_type:
+                raise ValueError("batch doesn't match the schema.")
+        return leaves
+
+    def _flatten(self, spec, batch, leaves):
+        if spec is None:
+            leaves.append(batch)
+            return
+        batch_type, keys, children = spec
+        if type(batch) is not batch_type or len(batch) != len(children):
+            raise ValueError("batch doesn't match the schema.")
+        if keys is None:
+            for child, field in zip(children, batch):
+                self._flatten(child, field, leaves)
+        else:
+            for child, key in zip(children, keys):
+                self._flatten(child, batch[key], leaves)
+
+    def unflatten(self, leaves):
+        """Returns a batch with this structure made up of `leaves`."""
+        return unflatten_batch(leaves, self.spec)
+
+    def concat(self, flattened_batches, pin_memory=False, pin_memory_device=None):
+        """Concatenates batches given as lists of leaves, returning the leaves
+        of the result."""
+        return [
+            _concat_leaves(
+                list(column),
+                pin_memory=pin_memory,
+                pin_memory_device=pin_memory_device,
+            )
+            for column in zip(*flattened_batches)
+        ]
 
 
 def batch_len(batch):
-    # error_msg = "batch must be tensor, dict, or list: found {}"
-    if isinstance(batch, list):
-        if isinstance(batch[0], string_classes):
-            return len(batch)
+    """Returns the number of samples in `batch`."""
+    while not _is_leaf(batch):
+        if isinstance(batch, Mapping):
+            batch = next(iter(batch.values()))
         else:
-            return len(batch[0])
-    elif isinstance(batch, collections.Mapping):
-        first_key = list(batch.keys())[0]
-        return len(batch[first_key])
+            batch = batch[0]
     return len(batch)
 
 
 def slice_batch(batch, start=None, end=None):
-    if isinstance(batch, list):
-        if isinstance(batch[0], string_classes):
-            return batch[start:end]
-        else:
-            return [sample[start:end] for sample in batch]
-    elif isinstance(batch[0], collections.Mapping):
-        return {key: batch[key][start:end] for key in batch}
-    else:
-        return batch[start:end]
+    """Returns the samples from `start` to `end` of `batch`, with the same
+    structure as `batch`."""
+    leaves, spec = flatten_batch(batch)
+    return unflatten_batch([leaf[start:end] for leaf in leaves], spec)
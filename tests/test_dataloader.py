@@ -0,0 +1,370 @@
+import inspect
+import threading
+import time
+import unittest
+
+try:
+    import unittest.mock as mock
+except ImportError:
+    import mock
+
+import torch
+import torch.utils.data as data
+
+import nonechucks
+from nonechucks.dataloader import (
+    _BatchCoalescer,
+    _OriginalDataset,
+    _OverprovisioningBatchSampler,
+)
+from nonechucks.utils import BatchSchema
+from test_dataset import AsyncFlakyDataset, FlakyDataset, FlakyStream, ProbedDataset
+
+
+class SlowDataset(FlakyDataset):
+    """A `FlakyDataset` that takes a while to load each sample, recording the
+    threads it is loaded by."""
+
+    def __init__(self, length, k=3):
+        super(SlowDataset, self).__init__(length, k)
+        self.threads = set()
+
+    def __getitem__(self, idx):
+        self.threads.add(threading.current_thread().name)
+        time.sleep(0.001)
+        return super(SlowDataset, self).__getitem__(idx)
+
+
+class CountedDataset(FlakyDataset):
+    """A `FlakyDataset` that counts the samples loaded from it."""
+
+    def __init__(self, length, k=3):
+        super(CountedDataset, self).__init__(length, k)
+        self.num_loads = 0
+
+    def __getitem__(self, idx):
+        self.num_loads += 1
+        return super(CountedDataset, self).__getitem__(idx)
+
+
+class SafeDataLoaderTest(unittest.TestCase):
+    """Unit tests for `SafeDataLoader`."""
+
+    def test_worker_backfill(self):
+        safe_dataset = nonechucks.SafeDataset(FlakyDataset(10))
+        dataset = _OriginalDataset(safe_dataset)
+        self.assertEqual(dataset[3], None)
+
+        dataset = _OriginalDataset(safe_dataset, backfill=True)
+        self.assertEqual(dataset[3], 4)
+        # Replacements come from outside the batch, each of them only once.
+        self.assertEqual(dataset.__getitems__([0, 1, 2, 3, 4, 5]), [7, 1, 2, 8, 4, 5])
+        self.assertEqual(dataset.__getitems__([0, 3, 6, 9]), [1, 2, 4, 5])
+        # Samples left without a replacement are dropped.
+        self.assertEqual(
+            dataset.__getitems__(list(range(8))), [8, 1, 2, None, 4, 5, None, 7]
+        )
+
+    def test_coalescer(self):
+        coalescer = _BatchCoalescer(4)
+        batch = torch.arange(4)
+        coalescer.add(batch)
+        self.assertIs(coalescer.pop(), batch)
+
+        coalescer.add(torch.arange(3))
+        coalescer.add([])
+        self.assertIsNone(coalescer.pop())
+        coalescer.add(torch.arange(3, 9))
+        self.assertEqual(coalescer.pop().tolist(), [0, 1, 2, 3])
+        self.assertEqual(coalescer.pop().tolist(), [4, 5, 6, 7])
+        self.assertIsNone(coalescer.pop())
+        self.assertEqual(len(coalescer), 1)
+        self.assertEqual(coalescer.pop(final=True).tolist(), [8])
+        self.assertIsNone(coalescer.pop(final=True))
+
+        coalescer = _BatchCoalescer(4, drop_last=True)
+        coalescer.add(torch.arange(3))
+        self.assertIsNone(coalescer.pop(final=True))
+
+        # full batches skip the pool unless there are samples left in it
+        coalescer = _BatchCoalescer(4)
+        batch = torch.arange(4)
+        self.assertEqual(coalescer.offer(batch), (batch, 4))
+        self.assertEqual(coalescer.offer([]), (None, 0))
+        self.assertEqual(coalescer.offer(torch.arange(3)), (None, 3))
+        self.assertEqual(coalescer.offer(batch), (None, 4))
+        self.assertEqual(len(coalescer), 7)
+
+    @mock.patch("nonechucks.utils._concat_leaves")
+    @mock.patch("nonechucks.dataloader.pin_memory")
+    def test_coalescer_pin_memory(self, mock_pin_memory, mock_concat_leaves):
+        coalescer = _BatchCoalescer(4, pin_memory=True)
+        coalescer.add(torch.arange(4))
+        coalescer.pop()
+        mock_pin_memory.assert_called_once()
+
+        coalescer.add(torch.arange(2))
+        coalescer.add(torch.arange(2))
+        coalescer.pop()
+        # assembled straight into pinned memory rather than pinned afterwards
+        mock_pin_memory.assert_called_once()
+        self.assertEqual(
+            mock_concat_leaves.call_args[1],
+            {"pin_memory": True, "pin_memory_device": None},
+        )
+
+        # batches pinned as they were loaded are left as they are
+        coalescer = _BatchCoalescer(4, pin_memory=True, pinned_input=True)
+        coalescer.add(torch.arange(4))
+        coalescer.add(torch.arange(6))
+        coalescer.pop()
+        coalescer.pop()
+        mock_pin_memory.assert_called_once()
+        coalescer.add(torch.arange(2))
+        coalescer.pop(final=True)
+        self.assertEqual(mock_concat_leaves.call_count, 2)
+
+    @unittest.skipUnless(
+        hasattr(torch, "accelerator"), "requires torch.accelerator (PyTorch 2.6+)"
+    )
+    @mock.patch("torch.accelerator.is_available", return_value=True)
+    @mock.patch("torch.accelerator.current_device_index", return_value=0)
+    @mock.patch("torch.accelerator.set_device_index")
+    @mock.patch("torch.utils.data._utils.pin_memory.pin_memory")
+    @mock.patch(
+        "nonechucks.utils._concat_leaves",
+        side_effect=lambda leaves, **kwargs: torch.cat(leaves),
+    )
+    def test_workers_pin_memory(self, mock_concat_leaves, mock_pin_memory, *mocks):
+        mock_pin_memory.side_effect = lambda batch, device=None: batch
+        loader = nonechucks.SafeDataLoader(
+            nonechucks.SafeDataset(FlakyDataset(16)),
+            batch_size=4,
+            num_workers=2,
+            pin_memory=True,
+        )
+        iterator = iter(loader)
+        # Batches are pinned by the pin memory thread as they are loaded, and
+        # the coalescer only assembles the ones made up of several pieces.
+        self.assertTrue(iterator._pin_memory_thread.is_alive())
+        self.assertTrue(iterator.coalescer.pinned_input)
+        self.assertEqual(len(list(iterator)), 3)
+        self.assertEqual(mock_pin_memory.call_count, 4)
+        for call in mock_concat_leaves.call_args_list:
+            self.assertTrue(call[1]["pin_memory"])
+
+    @mock.patch("nonechucks.dataloader.pin_memory", side_effect=lambda batch: batch)
+    def test_threads_pin_memory(self, mock_pin_memory):
+        loader = nonechucks.SafeDataLoader(
+            nonechucks.SafeDataset(data.TensorDataset(torch.arange(16))),
+            batch_size=4,
+            num_threads=2,
+        )
+        iterator = iter(loader)
+        iterator._pin_memory = True
+        iterator._init_coalescing(loader)
+        self.assertTrue(iterator.coalescer.pinned_input)
+        self.assertEqual(len(list(iterator)), 4)
+        # pinned by the loading threads, once per loaded batch
+        self.assertEqual(mock_pin_memory.call_count, 4)
+
+    @mock.patch("nonechucks.dataloader.pin_memory", side_effect=lambda batch: batch)
+    def test_single_process_pin_memory(self, mock_pin_memory):
+        loader = nonechucks.SafeDataLoader(
+            nonechucks.SafeDataset(data.TensorDataset(torch.arange(16))),
+            batch_size=4,
+        )
+        iterator = iter(loader)
+        iterator._pin_memory = True
+        iterator._init_coalescing(loader)
+        self.assertFalse(iterator.coalescer.pinned_input)
+        self.assertEqual(len(list(iterator)), 4)
+        # pinned by the coalescer only, once per batch
+        self.assertEqual(mock_pin_memory.call_count, 4)
+
+    def test_coalescer_schema(self):
+        coalescer = _BatchCoalescer(4)
+        coalescer.add({"x": torch.arange(3), "name": ["a", "b", "c"]})
+        schema = coalescer.schema
+        coalescer.add({"x": torch.arange(3, 6), "name": ["d", "e", "f"]})
+        self.assertIs(coalescer.schema, schema)
+        batch = coalescer.pop()
+        self.assertEqual(batch["x"].tolist(), [0, 1, 2, 3])
+        self.assertEqual(batch["name"], ["a", "b", "c", "d"])
+
+        # a change of structure partway through a batch
+        coalescer.add({"x": torch.arange(6, 8), "name": ["g", "h"], "y": torch.ones(2)})
+        self.assertIsNot(coalescer.schema, schema)
+        with self.assertRaises(ValueError):
+            coalescer.pop()
+
+    def test_overprovisioning_batch_sampler(self):
+        batch_sampler = _OverprovisioningBatchSampler(range(100), 10, margin=1)
+        batches = iter(batch_sampler)
+        self.assertEqual(len(next(batches)), 11)
+        # 11 indices requested, 8 samples left after dropping the unsafe ones
+        batch_sampler.record(8)
+        self.assertAlmostEqual(batch_sampler.failure_rate, 3 / 11)
+        self.assertEqual(len(next(batches)), 14)
+
+    def test_overprovision(self):
+        for num_workers in (0, 2):
+            dataset = nonechucks.SafeDataset(FlakyDataset(100))
+            loader = nonechucks.SafeDataLoader(
+                dataset, batch_size=8, overprovision=True, num_workers=num_workers
+            )
+            batches = list(loader)
+            self.assertEqual([len(b) for b in batches], [8] * 8 + [2])
+            self.assertEqual(
+                torch.cat(batches).tolist(), [i for i in range(100) if i % 3 != 0]
+            )
+            self.assertGreater(loader.batch_sampler.failure_rate, 0.2)
+
+    def test_safe_batch_sampler(self):
+        valid = [i for i in range(100) if i % 3 != 0]
+        for num_workers in (0, 2):
+            dataset = nonechucks.SafeDataset(ProbedDataset(100))
+            loader = nonechucks.SafeDataLoader(
+                dataset,
+                batch_sampler=nonechucks.SafeBatchSampler(dataset, 8),
+                num_workers=num_workers,
+            )
+            # Only full batches are loaded, so none of them goes through the
+            # pool but the last one, and none is assembled from pieces.
+            with mock.patch.object(
+                _BatchCoalescer,
+                "_append",
+                autospec=True,
+                side_effect=_BatchCoalescer._append,
+            ) as mock_append:
+                with mock.patch.object(
+                    BatchSchema,
+                    "__init__",
+                    autospec=True,
+                    side_effect=BatchSchema.__init__,
+                ) as mock_schema:
+                    with mock.patch.object(BatchSchema, "concat") as mock_concat:
+                        batches = list(loader)
+            self.assertEqual(mock_append.call_count, 1)
+            mock_concat.assert_not_called()
+            # The structure of the batches is only worked out once.
+            self.assertEqual(mock_schema.call_count, 1)
+            self.assertEqual([len(b) for b in batches], [8] * 8 + [2])
+            self.assertEqual(torch.cat(batches).tolist(), valid)
+
+        # Samples are only loaded by the workers, not to validate them first.
+        dataset = CountedDataset(100)
+        safe_dataset = nonechucks.SafeDataset(dataset)
+        loader = nonechucks.SafeDataLoader(
+            safe_dataset,
+            batch_sampler=nonechucks.SafeBatchSampler(safe_dataset, 8, shuffle=True),
+            num_workers=2,
+        )
+        self.assertEqual(sorted(torch.cat(list(loader)).tolist()), valid)
+        self.assertEqual(dataset.num_loads, 0)
+
+        # Without a probe, the batches are filled in as they are loaded.
+        dataset = nonechucks.SafeDataset(FlakyDataset(100))
+        loader = nonechucks.SafeDataLoader(
+            dataset,
+            batch_sampler=nonechucks.SafeBatchSampler(dataset, 8, drop_last=True),
+        )
+        batches = list(loader)
+        self.assertEqual([len(b) for b in batches], [8] * 8)
+        self.assertEqual(torch.cat(batches).tolist(), valid[:64])
+
+    def test_retry_with_probability(self):
+        # Every unsafe sample is retried with probability p per epoch, however
+        # many times the sampler and the loader look at it.
+        for shuffle in (False, True):
+            dataset = CountedDataset(1000, k=1)
+            safe_dataset = nonechucks.SafeDataset(
+                dataset, retry_policy=nonechucks.RetryWithProbability(0.5, seed=0)
+            )
+            loader = nonechucks.SafeDataLoader(
+                safe_dataset, batch_size=10, shuffle=shuffle
+            )
+            self.assertEqual(list(loader), [])
+            self.assertEqual(dataset.num_loads, 1000)
+            dataset.num_loads = 0
+            list(loader)
+            self.assertGreater(dataset.num_loads, 430)
+            self.assertLess(dataset.num_loads, 570)
+
+    def test_retry_with_workers(self):
+        # The epochs samples fail in are shared by the workers with the main
+        # process, along with the samples themselves.
+        flaky = FlakyDataset(10)
+        safe_dataset = nonechucks.SafeDataset(
+            flaky, retry_policy=nonechucks.RetryEveryNEpochs(2)
+        )
+        loader = nonechucks.SafeDataLoader(safe_dataset, batch_size=2, num_workers=2)
+        epochs = []
+        for epoch in range(3):
+            safe_dataset.set_epoch(epoch)
+            epochs.append(sorted(torch.cat(list(loader)).tolist()))
+            # Only multiples of 100 fail after the first epoch.
+            flaky.k = 100
+        self.assertEqual(epochs[0], [1, 2, 4, 5, 7, 8])
+        self.assertEqual(epochs[1], [1, 2, 4, 5, 7, 8])
+        self.assertEqual(epochs[2], list(range(1, 10)))
+
+    def test_iterator_options(self):
+        valid = [i for i in range(100) if i % 3 != 0]
+        dataset = nonechucks.SafeDataset(FlakyDataset(100))
+        loader = nonechucks.SafeDataLoader(
+            dataset, batch_size=8, shuffle=True, generator=torch.Generator()
+        )
+        self.assertEqual(sorted(torch.cat(list(loader)).tolist()), valid)
+
+        kwargs = dict(prefetch_factor=4, persistent_workers=True)
+        if "in_order" in inspect.signature(torch.utils.data.DataLoader).parameters:
+            kwargs["in_order"] = False
+        dataset = nonechucks.SafeDataset(FlakyDataset(100))
+        loader = nonechucks.SafeDataLoader(
+            dataset, batch_size=8, num_workers=2, drop_last=True, **kwargs
+        )
+        for _ in range(2):
+            batches = list(loader)
+            self.assertEqual([len(b) for b in batches], [8] * 8)
+            self.assertTrue(set(torch.cat(batches).tolist()) <= set(valid))
+
+    def test_async_dataset(self):
+        flaky = AsyncFlakyDataset(100)
+        dataset = nonechucks.AsyncSafeDataset(flaky)
+        loader = nonechucks.SafeDataLoader(dataset, batch_size=16)
+        batches = list(loader)
+        self.assertEqual([len(b) for b in batches], [16] * 4 + [2])
+        self.assertEqual(
+            torch.cat(batches).tolist(), [i for i in range(100) if i % 3 != 0]
+        )
+        if (nonechucks.MAJOR, nonechucks.MINOR) >= (2, 1):
+            # Batches are loaded through __getitems__
+            self.assertGreater(flaky.max_fetching, 1)
+
+    def test_num_threads(self):
+        slow = SlowDataset(100)
+        dataset = nonechucks.SafeDataset(slow)
+        loader = nonechucks.SafeDataLoader(dataset, batch_size=8, num_threads=4)
+        batches = list(loader)
+        self.assertEqual([len(b) for b in batches], [8] * 8 + [2])
+        self.assertEqual(
+            torch.cat(batches).tolist(), [i for i in range(100) if i % 3 != 0]
+        )
+        self.assertEqual(len(slow.threads), 4)
+        self.assertNotIn(threading.current_thread().name, slow.threads)
+
+    def test_iterable_dataset(self):
+        valid = [i for i in range(200) if i % 3 != 0 and i % 5 != 0]
+        for num_workers in (0, 2):
+            dataset = nonechucks.SafeIterableDataset(FlakyStream(200), shard=True)
+            loader = nonechucks.SafeDataLoader(
+                dataset, batch_size=8, num_workers=num_workers
+            )
+            batches = list(loader)
+            self.assertEqual([len(b) for b in batches], [8] * 13 + [3])
+            self.assertEqual(sorted(torch.cat(batches).tolist()), valid)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,4 +1,12 @@
+import asyncio
 import collections
+import copy
+import gc
+import multiprocessing
+import os
+import pickle
+import shutil
+import tempfile
 import unittest
 
 try:
@@ -13,6 +21,88 @@ from nonechucks import *
 import nonechucks
 
 
+class FlakyDataset(data.Dataset):
+    """A dataset of integers in which every multiple of `k` fails to load."""
+
+    def __init__(self, length, k=3):
+        self.length = length
+        self.k = k
+
+    def __getitem__(self, idx):
+        if idx % self.k == 0:
+            raise IOError("corrupt sample {}".format(idx))
+        return idx
+
+    def __len__(self):
+        return self.length
+
+
+class ProbedDataset(FlakyDataset):
+    """A `FlakyDataset` that can tell which samples are valid without loading
+    them."""
+
+    def __init__(self, length, k=3):
+        super(ProbedDataset, self).__init__(length, k)
+        self.num_loads = 0
+
+    def __getitem__(self, idx):
+        self.num_loads += 1
+        return super(ProbedDataset, self).__getitem__(idx)
+
+    def is_valid(self, idx):
+        return idx % self.k != 0
+
+
+class AsyncFlakyDataset(FlakyDataset):
+    """A `FlakyDataset` with an async `__getitem__`, which keeps track of the
+    largest number of samples fetched at the same time."""
+
+    def __init__(self, length, k=3):
+        super(AsyncFlakyDataset, self).__init__(length, k)
+        self.num_fetching = self.max_fetching = 0
+
+    async def __getitem__(self, idx):
+        self.num_fetching += 1
+        self.max_fetching = max(self.max_fetching, self.num_fetching)
+        try:
+            await asyncio.sleep(0.001)
+            return super(AsyncFlakyDataset, self).__getitem__(idx)
+        finally:
+            self.num_fetching -= 1
+
+
+class FlakyStream(data.IterableDataset):
+    """A stream of `length` integers in which multiples of 3 fail to load and
+    multiples of 5 are None."""
+
+    def __init__(self, length):
+        self.length = length
+
+    def __iter__(self):
+        return FlakyStream.Iterator(self.length)
+
+    class Iterator(object):
+        def __init__(self, length):
+            self.length = length
+            self.position = 0
+
+        def __iter__(self):
+            return self
+
+        def __next__(self):
+            idx = self.position
+            if idx >= self.length:
+                raise StopIteration
+            self.position += 1
+            if idx % 3 == 0:
+                raise IOError("corrupt sample {}".format(idx))
+            return None if idx % 5 == 0 else idx
+
+
+def load_in_subprocess(safe_dataset, idx):
+    safe_dataset._safe_get_item(idx)
+
+
 class SafeDatasetTest(unittest.TestCase):
     """Unit tests for `SafeDataset`."""
 
@@ -43,12 +133,229 @@ class SafeDatasetTest(unittest.TestCase):
         self.assertTrue(dataset.safe.is_index_built)
         self.assertEqual(len(dataset.safe), len(dataset.unsafe))
 
+    @mock.patch("torch.utils.data.TensorDataset.__getitem__")
+    def test_index_tracks_unsafe_samples(self, mock_get_item):
+        def side_effect(idx):
+            if idx in (2, 5):
+                raise IOError
+            return idx
+
+        mock_get_item.side_effect = side_effect
+        dataset = data.TensorDataset(torch.arange(0, 10))
+        dataset = self.get_safe_dataset_pair(dataset).safe
+        self.assertEqual(dataset._safe_get_item(1), 1)
+        self.assertIsNone(dataset._safe_get_item(2))
+        self.assertIsNone(dataset._safe_get_item(-5))
+        self.assertEqual(dataset.num_samples_examined, 3)
+        self.assertTrue(dataset._index.is_safe(1))
+        self.assertTrue(dataset._index.is_unsafe(5))
+        with self.assertRaises(IndexError):
+            dataset._safe_get_item(10)
+
+        dataset._reset_index()
+        self.assertEqual(dataset.num_samples_examined, 0)
+        self.assertFalse(dataset.is_index_built)
+
+    @mock.patch("torch.utils.data.TensorDataset.__getitem__")
+    def test_unsafe_samples_are_not_reloaded(self, mock_get_item):
+        mock_get_item.side_effect = IOError
+        dataset = data.TensorDataset(torch.arange(0, 10))
+        dataset = self.get_safe_dataset_pair(dataset).safe
+        for _ in range(3):
+            self.assertIsNone(dataset._safe_get_item(4))
+        self.assertEqual(mock_get_item.call_count, 1)
+
+    @mock.patch("torch.utils.data.TensorDataset.__getitem__")
+    def test_retry_every_n_epochs(self, mock_get_item):
+        mock_get_item.side_effect = IOError
+        dataset = data.TensorDataset(torch.arange(0, 10))
+        dataset = self.get_safe_dataset_pair(
+            dataset, retry_policy=RetryEveryNEpochs(2)
+        ).safe
+        self.assertIsNone(dataset._safe_get_item(4))
+        dataset.set_epoch(1)
+        self.assertIsNone(dataset._safe_get_item(4))
+        self.assertEqual(mock_get_item.call_count, 1)
+
+        mock_get_item.side_effect = lambda idx: idx
+        dataset.set_epoch(2)
+        self.assertEqual(dataset._safe_get_item(4), 4)
+        self.assertTrue(dataset._index.is_safe(4))
+        self.assertEqual(dataset.num_samples_examined, 1)
+
+    def test_out_of_range(self):
+        safe_dataset = nonechucks.SafeDataset(FlakyDataset(10))
+        self.assertEqual(safe_dataset[-2], 8)
+        for idx in (10, -11, -20):
+            with self.assertRaises(IndexError):
+                safe_dataset[idx]
+
+    def test_failed_epochs(self):
+        # Only recorded for policies that look at them.
+        safe_dataset = nonechucks.SafeDataset(FlakyDataset(100))
+        list(safe_dataset)
+        self.assertIsNone(safe_dataset._failed_epochs)
+
+        safe_dataset = nonechucks.SafeDataset(
+            FlakyDataset(100), retry_policy=RetryEveryNEpochs(2)
+        )
+        safe_dataset.set_epoch(1)
+        list(safe_dataset)
+        self.assertEqual(safe_dataset._failed_epochs.dtype, torch.int32)
+        self.assertEqual(safe_dataset._failed_epoch(3), 1)
+        self.assertIsNone(safe_dataset._failed_epoch(4))
+
+    def test_retry_when_indexing(self):
+        flaky = FlakyDataset(10)
+        safe_dataset = nonechucks.SafeDataset(flaky, retry_policy=RetryEveryNEpochs(1))
+        self.assertEqual(list(safe_dataset), [1, 2, 4, 5, 7, 8])
+        # Only multiples of 100 fail from now on.
+        flaky.k = 100
+        self.assertEqual(safe_dataset[3], 4)
+        self.assertEqual(list(safe_dataset), [1, 2, 4, 5, 7, 8])
+
+        safe_dataset.set_epoch(1)
+        self.assertEqual(safe_dataset[3], 3)
+        self.assertEqual(list(safe_dataset), list(range(1, 10)))
+
+    @mock.patch("torch.utils.data.TensorDataset.__getitem__")
+    def test_saved_index(self, mock_get_item):
+        mock_get_item.side_effect = lambda idx: None if idx % 3 == 0 else idx
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        index_path = os.path.join(tmp_dir, "fruits.idx")
+
+        dataset = data.TensorDataset(torch.arange(0, 10))
+        safe_dataset = nonechucks.SafeDataset(
+            dataset, eager_eval=True, index_path=index_path, index_version="v1"
+        )
+        self.assertTrue(os.path.exists(index_path))
+        self.assertEqual(mock_get_item.call_count, 10)
+
+        loaded = nonechucks.SafeDataset(
+            dataset, eager_eval=True, index_path=index_path, index_version="v1"
+        )
+        self.assertEqual(mock_get_item.call_count, 10)
+        self.assertTrue(loaded.is_index_built)
+        self.assertEqual(loaded._index.num_unsafe, 4)
+        self.assertTrue(loaded._index.is_unsafe(9))
+        self.assertTrue(loaded._index.is_safe(8))
+        # Copies sent to DataLoader workers carry the index with them.
+        copied = pickle.loads(pickle.dumps(loaded._index))
+        self.assertEqual(bytes(copied.buffer), bytes(loaded._index.buffer))
+
+        stale = nonechucks.SafeDataset(
+            dataset, index_path=index_path, index_version="v2"
+        )
+        self.assertEqual(stale.num_samples_examined, 0)
+
+    def test_parallel_build_index(self):
+        dataset = FlakyDataset(100)
+        serial = nonechucks.SafeDataset(dataset, eager_eval=True)
+        parallel = nonechucks.SafeDataset(dataset, eager_eval=3, index_chunk_size=16)
+        self.assertTrue(parallel.is_index_built)
+        self.assertEqual(parallel._index.num_unsafe, 34)
+        self.assertEqual(bytes(parallel._index.buffer), bytes(serial._index.buffer))
+
+    def test_build_index_with_probe(self):
+        dataset = ProbedDataset(20)
+        safe_dataset = nonechucks.SafeDataset(dataset, eager_eval=True)
+        self.assertTrue(safe_dataset.is_index_built)
+        self.assertEqual(safe_dataset._index.num_unsafe, 7)
+        self.assertEqual(dataset.num_loads, 0)
+
+        parallel = nonechucks.SafeDataset(dataset, eager_eval=2, index_chunk_size=8)
+        self.assertEqual(
+            bytes(parallel._index.buffer), bytes(safe_dataset._index.buffer)
+        )
+
+    def test_shared_index(self):
+        safe_dataset = nonechucks.SafeDataset(FlakyDataset(10)).share_memory_()
+        self.assertTrue(safe_dataset._index.is_shared)
+        for method, indices in (("fork", (3, 4)), ("spawn", (6,))):
+            context = multiprocessing.get_context(method)
+            for idx in indices:
+                process = context.Process(
+                    target=load_in_subprocess, args=(safe_dataset, idx)
+                )
+                process.start()
+                process.join()
+                self.assertEqual(process.exitcode, 0)
+        self.assertTrue(safe_dataset._index.is_unsafe(3))
+        self.assertTrue(safe_dataset._index.is_safe(4))
+        self.assertTrue(safe_dataset._index.is_unsafe(6))
+        self.assertEqual(safe_dataset.num_samples_examined, 3)
+
+    def test_copy_after_sharing(self):
+        safe_dataset = nonechucks.SafeDataset(FlakyDataset(10))
+        loader = nonechucks.SafeDataLoader(safe_dataset, num_workers=2)
+        self.assertTrue(safe_dataset._index.is_shared)
+        list(loader)
+        for copied in (
+            copy.deepcopy(safe_dataset),
+            pickle.loads(pickle.dumps(safe_dataset)),
+        ):
+            self.assertFalse(copied._index.is_shared)
+            self.assertEqual(copied.num_samples_examined, 10)
+
+        safe_dataset = nonechucks.SafeDataset(FlakyDataset(10))
+        nonechucks.SafeDataLoader(safe_dataset, num_workers=2, share_index=False)
+        self.assertFalse(safe_dataset._index.is_shared)
+
+    def test_compact(self):
+        safe_dataset = nonechucks.SafeDataset(FlakyDataset(10))
+        compact = safe_dataset.compact()
+        self.assertTrue(safe_dataset.is_index_built)
+        self.assertEqual(len(compact), 6)
+        self.assertEqual([compact[i] for i in range(6)], [1, 2, 4, 5, 7, 8])
+        self.assertEqual(compact[-1], 8)
+        with self.assertRaises(IndexError):
+            compact[6]
+
+        loader = data.DataLoader(compact, batch_size=4, shuffle=True)
+        self.assertEqual(sorted(torch.cat(list(loader)).tolist()), [1, 2, 4, 5, 7, 8])
+
+    def test_compact_reuses_index_settings(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        index_path = os.path.join(tmp_dir, "flaky.idx")
+
+        safe_dataset = nonechucks.SafeDataset(
+            FlakyDataset(10), index_path=index_path, index_chunk_size=4
+        )
+        with mock.patch.object(
+            safe_dataset, "_build_index", wraps=safe_dataset._build_index
+        ) as build_index:
+            compact = safe_dataset.compact()
+        build_index.assert_called_once_with(num_workers=0, chunk_size=4)
+        self.assertEqual(len(compact), 6)
+        self.assertTrue(os.path.exists(index_path))
+
+        loaded = nonechucks.SafeDataset(FlakyDataset(10), index_path=index_path)
+        self.assertTrue(loaded.is_index_built)
+        self.assertEqual(len(loaded.compact()), 6)
+
     def test_dataset_iterator(self):
         counter = 0
         for i in self.dataset.safe:
             self.assertEqual(i[0].tolist(), counter)
             counter += 1
 
+    def test_iter_loads_each_sample_once(self):
+        dataset = ProbedDataset(50)
+        safe_dataset = nonechucks.SafeDataset(dataset)
+        safe_dataset._safe_get_item(3)
+        expected = [i for i in range(50) if i % 3 != 0]
+        self.assertEqual(list(safe_dataset), expected)
+        self.assertEqual(dataset.num_loads, 50)
+        # Unsafe samples are known by now, so they aren't loaded again.
+        self.assertEqual(list(safe_dataset), expected)
+        self.assertEqual(dataset.num_loads, 50 + len(expected))
+
+        prefetched = nonechucks.SafeDataset(ProbedDataset(50), prefetch=4)
+        self.assertEqual(list(prefetched), expected)
+        self.assertTrue(prefetched.is_index_built)
+
     def test_iter_calls_safe_get_item(self):
         dataset = data.TensorDataset(torch.arange(0, 10))
         dataset = self.get_safe_dataset_pair(dataset).safe
@@ -69,12 +376,138 @@ class SafeDatasetTest(unittest.TestCase):
     #     self.assertEqual(dataset.safe[4], 14)
 
     def test_memoization(self):
-        pass
+        # Each sample is a 0-d int64 tensor, so the cache holds 2 samples.
+        safe_dataset = nonechucks.SafeDataset(
+            data.TensorDataset(torch.arange(0, 10)), cache=LRUCache(16)
+        )
+        for idx in (0, 1, 0, 2, 0, 1):
+            safe_dataset[idx]
+        cache = safe_dataset.cache
+        self.assertEqual((cache.hits, cache.misses), (2, 4))
+        self.assertEqual(cache.nbytes, 16)
+        self.assertIn(0, cache)
+        self.assertNotIn(2, cache)
+
+        # Small Python ints take up 28 bytes, so the cache holds 3 samples.
+        safe_dataset = nonechucks.SafeDataset(ProbedDataset(10), cache=LFUCache(84))
+        for idx in (1, 1, 1, 2, 2, 4, 5):
+            self.assertEqual(safe_dataset[idx], idx)
+        self.assertEqual(sorted(safe_dataset.cache._entries), [1, 2, 5])
+        # 3 is unsafe, so dataset[3] is served by the next sample.
+        self.assertEqual(safe_dataset[3], 4)
+
+        # Negative indices are cached under the index they stand for.
+        safe_dataset = nonechucks.SafeDataset(FlakyDataset(10), cache=LRUCache(1024))
+        self.assertEqual(safe_dataset[-2], 8)
+        self.assertEqual(safe_dataset[-2], 8)
+        self.assertEqual(safe_dataset[8], 8)
+        cache = safe_dataset.cache
+        self.assertEqual((cache.hits, cache.misses), (2, 1))
 
     def test_import(self):
         self.assertIsNotNone(SafeDataset)
         self.assertIsNotNone(SafeSampler)
 
 
+class AsyncSafeDatasetTest(unittest.TestCase):
+    """Unit tests for `AsyncSafeDataset`."""
+
+    def test_getitem(self):
+        dataset = nonechucks.AsyncSafeDataset(AsyncFlakyDataset(10))
+        self.assertEqual(dataset[2], 2)
+        self.assertEqual(dataset[3], 4)
+        self.assertTrue(dataset._index.is_unsafe(3))
+        self.assertEqual(asyncio.run(dataset.aget_item(6)), 7)
+        with self.assertRaises(IndexError):
+            asyncio.run(dataset.aget_item(9))
+
+    def test_iteration(self):
+        expected = [i for i in range(100) if i % 3 != 0]
+        flaky = AsyncFlakyDataset(100)
+        dataset = nonechucks.AsyncSafeDataset(flaky, max_concurrency=8)
+        self.assertEqual(list(dataset), expected)
+        self.assertEqual(flaky.max_fetching, 8)
+
+        async def consume():
+            return [sample async for sample in dataset]
+
+        flaky = AsyncFlakyDataset(100)
+        dataset = nonechucks.AsyncSafeDataset(flaky, max_concurrency=4)
+        self.assertEqual(asyncio.run(consume()), expected)
+        self.assertEqual(flaky.max_fetching, 4)
+
+    def test_eager_eval(self):
+        dataset = nonechucks.AsyncSafeDataset(
+            AsyncFlakyDataset(50), eager_eval=True, index_chunk_size=16
+        )
+        self.assertTrue(dataset.is_index_built)
+        self.assertEqual(dataset._index.num_unsafe, 17)
+
+    def test_event_loops_are_closed(self):
+        dataset = nonechucks.AsyncSafeDataset(AsyncFlakyDataset(10))
+        self.assertEqual(dataset[3], 4)
+        loops = list(dataset._loops)
+        self.assertEqual(len(loops), 1)
+        self.assertFalse(loops[0].is_closed())
+        del dataset
+        gc.collect()
+        self.assertTrue(loops[0].is_closed())
+
+    def test_pickle(self):
+        dataset = nonechucks.AsyncSafeDataset(AsyncFlakyDataset(10))
+        dataset = pickle.loads(pickle.dumps(dataset))
+        self.assertEqual(dataset[3], 4)
+
+
+class SafeIterableDatasetTest(unittest.TestCase):
+    """Unit tests for `SafeIterableDataset`."""
+
+    def test_iteration(self):
+        dataset = nonechucks.SafeIterableDataset(FlakyStream(20))
+        self.assertEqual(list(dataset), [1, 2, 4, 7, 8, 11, 13, 14, 16, 17, 19])
+
+    def test_transform(self):
+        def transform(sample):
+            if sample % 2 == 0:
+                raise ValueError
+            return None if sample == 7 else -sample
+
+        dataset = nonechucks.SafeIterableDataset(FlakyStream(20), transform)
+        self.assertEqual(list(dataset), [-1, -11, -13, -17, -19])
+
+    def test_sharding(self):
+        dataset = nonechucks.SafeIterableDataset(FlakyStream(20))
+        worker_info = mock.Mock(num_workers=2, id=1)
+        with mock.patch("torch.utils.data.get_worker_info", return_value=worker_info):
+            self.assertEqual(len(list(dataset)), 11)
+            # Only the samples received are dealt out, not the failed reads.
+            dataset.shard = True
+            self.assertEqual(list(dataset), [2, 8, 11, 14, 17])
+            worker_info.id = 0
+            self.assertEqual(list(dataset), [1, 4, 7, 13, 16, 19])
+
+    def test_broken_stream(self):
+        class BrokenStream(data.IterableDataset):
+            def __init__(self):
+                self.num_calls = 0
+
+            def __iter__(self):
+                return self
+
+            def __next__(self):
+                self.num_calls += 1
+                if self.num_calls > 2:
+                    raise IOError("connection lost")
+                return self.num_calls
+
+        stream = BrokenStream()
+        dataset = nonechucks.SafeIterableDataset(stream, max_consecutive_errors=5)
+        iterator = iter(dataset)
+        self.assertEqual([next(iterator), next(iterator)], [1, 2])
+        with self.assertRaises(IOError):
+            next(iterator)
+        self.assertEqual(stream.num_calls, 7)
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,96 @@
+import copy
+import multiprocessing
+import pickle
+import random
+import unittest
+
+import torch
+
+from nonechucks.index import ValidityIndex
+
+
+def mark_safe_in_subprocess(index, idx):
+    index.mark_safe(idx)
+
+
+class ValidityIndexTest(unittest.TestCase):
+    """Unit tests for `ValidityIndex`."""
+
+    def test_mark(self):
+        index = ValidityIndex(20)
+        index.mark_safe(3)
+        index.mark_unsafe(17)
+        index.mark_unsafe(17)
+        self.assertEqual(index.state(3), ValidityIndex.SAFE)
+        self.assertEqual(index.state(17), ValidityIndex.UNSAFE)
+        self.assertEqual(index.state(4), ValidityIndex.UNKNOWN)
+        self.assertEqual((index.num_safe, index.num_unsafe), (1, 1))
+
+        index.mark_safe(17)
+        self.assertEqual(index.state(17), ValidityIndex.SAFE)
+        self.assertEqual((index.num_safe, index.num_unsafe), (2, 0))
+
+    def test_next_candidate(self):
+        rng = random.Random(0)
+        length = 1000
+        index = ValidityIndex(length)
+        unsafe = set(range(100, 400)) | set(range(630, 700)) | {5, 6, 999}
+        unsafe |= set(rng.sample(range(length), 50))
+        for idx in unsafe:
+            index.mark_unsafe(idx)
+
+        def expected(idx):
+            while idx in unsafe:
+                idx += 1
+            return idx
+
+        for _ in range(2):
+            for idx in range(length):
+                self.assertEqual(index.next_candidate(idx), expected(idx))
+
+        # Jumps must not skip samples that stopped being unsafe.
+        index.mark_safe(300)
+        unsafe.remove(300)
+        self.assertEqual(index.next_candidate(150), 300)
+
+    def test_indices_without_frombuffer(self):
+        index = ValidityIndex(20)
+        index.mark_safe(2)
+        index.mark_unsafe(17)
+        expected = (index.safe_indices(), index.candidate_indices())
+
+        # torch.frombuffer only exists from PyTorch 1.10 onwards.
+        frombuffer = torch.frombuffer
+        del torch.frombuffer
+        self.addCleanup(setattr, torch, "frombuffer", frombuffer)
+        self.assertEqual(index.safe_indices().tolist(), expected[0].tolist())
+        self.assertEqual(index.candidate_indices().tolist(), expected[1].tolist())
+
+    def test_copy_shared_index(self):
+        index = ValidityIndex(20).share_memory_()
+        index.mark_unsafe(3)
+        for copied in (copy.deepcopy(index), pickle.loads(pickle.dumps(index))):
+            self.assertFalse(copied.is_shared)
+            self.assertTrue(copied.is_unsafe(3))
+            copied.mark_unsafe(4)
+            self.assertFalse(index.is_unsafe(4))
+
+    def test_shared_jumps(self):
+        index = ValidityIndex(1000).share_memory_()
+        for idx in range(100, 400):
+            index.mark_unsafe(idx)
+        self.assertEqual(index.next_candidate(150), 400)
+
+        # Jumps recorded here must not skip samples that stopped being unsafe
+        # in another process.
+        process = multiprocessing.get_context("spawn").Process(
+            target=mark_safe_in_subprocess, args=(index, 300)
+        )
+        process.start()
+        process.join()
+        self.assertEqual(process.exitcode, 0)
+        self.assertEqual(index.next_candidate(150), 300)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,3 +1,6 @@
+import multiprocessing
+import os
+import tempfile
 import unittest
 
 try:
@@ -6,9 +9,34 @@ except ImportError:
     import mock
 
 import torch
+import torch.distributed as dist
 import torch.utils.data as data
 
 import nonechucks
+from test_dataset import FlakyDataset, ProbedDataset
+
+
+def load_distributed(rank, world_size, init_file, results):
+    dist.init_process_group(
+        "gloo",
+        init_method="file://" + init_file,
+        rank=rank,
+        world_size=world_size,
+    )
+    try:
+        # Every multiple of 4 is even, so rank 0 gets all the unsafe samples.
+        safe_dataset = nonechucks.SafeDataset(FlakyDataset(100, k=4))
+        sampler = nonechucks.DistributedSafeSampler(
+            safe_dataset, batch_size=4, shuffle=False
+        )
+        loader = nonechucks.SafeDataLoader(safe_dataset, batch_size=4, sampler=sampler)
+        epochs = []
+        for epoch in range(2):
+            sampler.set_epoch(epoch)
+            epochs.append([batch.tolist() for batch in loader])
+        results.put((rank, len(sampler), epochs))
+    finally:
+        dist.destroy_process_group()
 
 
 class SafeSamplerTest(unittest.TestCase):
@@ -48,6 +76,204 @@ class SafeSamplerTest(unittest.TestCase):
         for i_batch, sample_batched in enumerate(dataloader):
             print("Sample {}: {}".format(i_batch, sample_batched))
 
+    def test_sampler_uses_probe(self):
+        dataset = ProbedDataset(10)
+        safe_dataset = nonechucks.SafeDataset(dataset)
+        indices = list(nonechucks.SafeSampler(safe_dataset))
+        self.assertEqual(indices, [1, 2, 4, 5, 7, 8])
+        self.assertEqual(dataset.num_loads, 0)
+
+    def test_deferred_validation(self):
+        dataset = FlakyDataset(10)
+        safe_dataset = nonechucks.SafeDataset(dataset)
+        safe_dataset._safe_get_item(3)
+        sampler = nonechucks.SafeSampler(safe_dataset, defer_validation=True)
+        self.assertEqual(list(sampler), [0, 1, 2, 4, 5, 6, 7, 8, 9])
+        self.assertEqual(safe_dataset.num_samples_examined, 1)
+
+        probed = nonechucks.SafeDataset(ProbedDataset(10))
+        sampler = nonechucks.SafeSampler(probed, defer_validation=True)
+        self.assertEqual(list(sampler), [1, 2, 4, 5, 7, 8])
+
+    def test_lazy_sampling(self):
+        num_pulled = [0]
+
+        def indices():
+            for idx in range(10**9):
+                num_pulled[0] += 1
+                yield idx % 10
+
+        safe_dataset = nonechucks.SafeDataset(FlakyDataset(10))
+        sampler = nonechucks.SafeSampler(safe_dataset, indices(), window_size=4)
+        iterator = iter(sampler)
+        self.assertEqual([next(iterator) for _ in range(4)], [1, 2, 4, 5])
+        self.assertEqual(num_pulled[0], 6)
+
+    def test_step_to_index_fn_window(self):
+        def step_back(num_valid_samples, num_samples_examined):
+            # revisits the previous position after every valid sample
+            return num_samples_examined - num_valid_samples % 2
+
+        safe_dataset = nonechucks.SafeDataset(ProbedDataset(10))
+        sampler = nonechucks.SafeSampler(
+            safe_dataset, step_to_index_fn=step_back, window_size=2
+        )
+        self.assertEqual(list(sampler)[:5], [1, 1, 4, 4, 7])
+
+        def jump_back(num_valid_samples, num_samples_examined):
+            return 0 if num_samples_examined == 5 else num_samples_examined
+
+        sampler = nonechucks.SafeSampler(
+            safe_dataset, step_to_index_fn=jump_back, window_size=2
+        )
+        with self.assertRaises(ValueError):
+            list(sampler)
+
+    def test_random_sampler(self):
+        safe_dataset = nonechucks.SafeDataset(FlakyDataset(100))
+        for idx in range(0, 50, 3):
+            safe_dataset._safe_get_item(idx)
+        sampler = nonechucks.SafeRandomSampler(
+            safe_dataset, generator=torch.Generator().manual_seed(0)
+        )
+        self.assertEqual(len(sampler), 83)
+        indices = list(sampler)
+        self.assertEqual(sorted(indices), [i for i in range(100) if i % 3 != 0])
+        self.assertNotEqual(indices, sorted(indices))
+        self.assertEqual(len(sampler), 66)
+
+        # the same seed gives the same order
+        samplers = [
+            nonechucks.SafeRandomSampler(
+                safe_dataset, generator=torch.Generator().manual_seed(1)
+            )
+            for _ in range(2)
+        ]
+        self.assertEqual(list(samplers[0]), list(samplers[1]))
+
+    @mock.patch("nonechucks.SafeDataset._safe_get_item")
+    def test_random_sampler_skips_known_unsafe(self, mock_get_item):
+        safe_dataset = nonechucks.SafeDataset(FlakyDataset(10))
+        for idx in (0, 3, 6, 9):
+            safe_dataset._mark_unsafe(idx)
+        sampler = nonechucks.SafeRandomSampler(safe_dataset, defer_validation=True)
+        self.assertEqual(sorted(sampler), [1, 2, 4, 5, 7, 8])
+        mock_get_item.assert_not_called()
+
+        safe_dataset.retry_policy = nonechucks.RetryEveryNEpochs(1)
+        safe_dataset.set_epoch(1)
+        self.assertEqual(len(list(sampler)), 10)
+
+    def test_dataloader_uses_random_sampler(self):
+        safe_dataset = nonechucks.SafeDataset(FlakyDataset(10))
+        loader = nonechucks.SafeDataLoader(safe_dataset, shuffle=True)
+        self.assertIsInstance(loader.sampler, nonechucks.SafeRandomSampler)
+        self.assertEqual(sorted(torch.cat(list(loader)).tolist()), [1, 2, 4, 5, 7, 8])
+
+    def test_batch_sampler(self):
+        safe_dataset = nonechucks.SafeDataset(ProbedDataset(20))
+        batch_sampler = nonechucks.SafeBatchSampler(safe_dataset, 4)
+        self.assertEqual(len(batch_sampler), 5)
+        batches = list(batch_sampler)
+        self.assertEqual([len(batch) for batch in batches], [4, 4, 4, 1])
+        self.assertEqual(sum(batches, []), [i for i in range(20) if i % 3 != 0])
+        self.assertEqual(safe_dataset.dataset.num_loads, 0)
+        self.assertEqual(len(batch_sampler), 4)
+
+        batch_sampler = nonechucks.SafeBatchSampler(
+            safe_dataset, 4, sampler=data.RandomSampler(safe_dataset), drop_last=True
+        )
+        self.assertEqual(len(batch_sampler), 3)
+        self.assertEqual([len(batch) for batch in batch_sampler], [4, 4, 4])
+
+    def test_batch_sampler_uses_index(self):
+        safe_dataset = nonechucks.SafeDataset(FlakyDataset(10))
+        self.assertEqual(
+            list(nonechucks.SafeBatchSampler(safe_dataset, 4)),
+            [[0, 1, 2, 3], [4, 5, 6, 7], [8, 9]],
+        )
+        safe_dataset._build_index()
+        self.assertEqual(
+            list(nonechucks.SafeBatchSampler(safe_dataset, 4)),
+            [[1, 2, 4, 5], [7, 8]],
+        )
+
+    def test_distributed_sampler(self):
+        safe_dataset = nonechucks.SafeDataset(FlakyDataset(20))
+        samplers = [
+            nonechucks.DistributedSafeSampler(
+                safe_dataset, batch_size=2, num_replicas=2, rank=rank, seed=3
+            )
+            for rank in range(2)
+        ]
+        shards = [list(sampler) for sampler in samplers]
+        for shard in shards:
+            self.assertEqual(len(shard) % 2, 0)
+        self.assertFalse(set(shards[0]) & set(shards[1]))
+        for idx in shards[0] + shards[1]:
+            self.assertNotEqual(idx % 3, 0)
+
+        # the same epoch gives the same order, a different one doesn't
+        self.assertEqual(list(samplers[0]), shards[0])
+        samplers[0].set_epoch(1)
+        self.assertNotEqual(list(samplers[0]), shards[0])
+
+    def test_distributed_sampler_computes_indices_once_per_epoch(self):
+        safe_dataset = nonechucks.SafeDataset(FlakyDataset(20))
+        sampler = nonechucks.DistributedSafeSampler(
+            safe_dataset, batch_size=2, num_replicas=2, rank=0
+        )
+        with mock.patch.object(
+            sampler, "_compute_indices", wraps=sampler._compute_indices
+        ) as mock_compute:
+            indices = list(sampler)
+            self.assertEqual(len(sampler), len(indices))
+            self.assertEqual(list(sampler), indices)
+            self.assertEqual(mock_compute.call_count, 1)
+            sampler.set_epoch(1)
+            len(sampler)
+            list(sampler)
+            self.assertEqual(mock_compute.call_count, 2)
+
+    @unittest.skipUnless(dist.is_available(), "torch.distributed is not available")
+    def test_distributed_sampler_balances_ranks(self):
+        world_size = 2
+        context = multiprocessing.get_context("spawn")
+        results = context.Queue()
+        init_file = os.path.join(tempfile.mkdtemp(), "init")
+        processes = [
+            context.Process(
+                target=load_distributed,
+                args=(rank, world_size, init_file, results),
+            )
+            for rank in range(world_size)
+        ]
+        for process in processes:
+            process.start()
+        outputs = dict(
+            (rank, (length, epochs))
+            for rank, length, epochs in (results.get(timeout=120) for _ in processes)
+        )
+        for process in processes:
+            process.join()
+            self.assertEqual(process.exitcode, 0)
+
+        # Rank 0 finds 25 safe samples and rank 1 finds 50, which are dealt out
+        # as 9 batches each, leaving out only 3 of the 75.
+        for epoch in range(2):
+            seen = set()
+            for rank in range(world_size):
+                length, epochs = outputs[rank]
+                self.assertEqual(length, 36)
+                batches = epochs[epoch]
+                self.assertEqual([len(batch) for batch in batches], [4] * 9)
+                indices = set(sum(batches, []))
+                self.assertEqual(len(indices), 36)
+                self.assertFalse(indices & seen)
+                seen |= indices
+            for idx in seen:
+                self.assertNotEqual(idx % 4, 0)
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,103 @@
+import collections
+import unittest
+
+import torch
+
+from nonechucks.utils import BatchSchema, batch_len, concat_batches, slice_batch
+
+Sample = collections.namedtuple("Sample", ["image", "meta"])
+
+
+def nested_batch(start, end):
+    """Returns a batch of the samples from `start` to `end` made up of a
+    namedtuple holding a tensor and a nested dict."""
+    return Sample(
+        image=torch.arange(start, end).float().unsqueeze(1).repeat(1, 2),
+        meta={
+            "label": torch.arange(start, end),
+            "source": {"name": ["s{}".format(i) for i in range(start, end)]},
+        },
+    )
+
+
+class ConcatBatchesTest(unittest.TestCase):
+    """Unit tests for `concat_batches`, `batch_len` and `slice_batch`."""
+
+    def test_tensors(self):
+        batches = [torch.arange(0, 3), torch.arange(3, 4), torch.arange(4, 8)]
+        self.assertEqual(concat_batches(batches).tolist(), list(range(8)))
+
+    def test_fields(self):
+        batches = [
+            [torch.zeros(2, 3), torch.tensor([0, 1]), ["a", "b"]],
+            [torch.ones(1, 3), torch.tensor([2]), ["c"]],
+        ]
+        images, labels, names = concat_batches(batches)
+        self.assertEqual(images.shape, (3, 3))
+        self.assertEqual(images[2].tolist(), [1, 1, 1])
+        self.assertEqual(labels.tolist(), [0, 1, 2])
+        self.assertEqual(names, ["a", "b", "c"])
+
+        batches = [{"label": torch.tensor([0, 1])}, {"label": torch.tensor([2])}]
+        self.assertEqual(concat_batches(batches)["label"].tolist(), [0, 1, 2])
+
+    def test_nested(self):
+        batch = concat_batches([nested_batch(0, 2), nested_batch(2, 3)])
+        self.assertIsInstance(batch, Sample)
+        self.assertEqual(batch.image[:, 0].tolist(), [0, 1, 2])
+        self.assertEqual(batch.meta["label"].tolist(), [0, 1, 2])
+        self.assertEqual(batch.meta["source"]["name"], ["s0", "s1", "s2"])
+
+        batches = [(torch.zeros(2), ("a", "b")), (torch.ones(1), ("c",))]
+        batch = concat_batches(batches)
+        self.assertIsInstance(batch, tuple)
+        self.assertEqual(batch[1], ["a", "b", "c"])
+
+        with self.assertRaises(ValueError):
+            concat_batches([nested_batch(0, 2), {"label": torch.arange(2)}])
+
+    def test_len_and_slice(self):
+        batch = nested_batch(0, 5)
+        self.assertEqual(batch_len(batch), 5)
+        self.assertEqual(batch_len([["a", "b"], torch.zeros(2)]), 2)
+
+        head, tail = slice_batch(batch, end=2), slice_batch(batch, start=2)
+        self.assertIsInstance(head, Sample)
+        self.assertEqual(batch_len(head), 2)
+        self.assertEqual(tail.meta["label"].tolist(), [2, 3, 4])
+        self.assertEqual(tail.meta["source"]["name"], ["s2", "s3", "s4"])
+        joined = concat_batches([head, tail])
+        self.assertTrue(torch.equal(joined.image, batch.image))
+
+    def test_schema(self):
+        schema = BatchSchema(nested_batch(0, 2))
+        leaves = schema.flatten(nested_batch(2, 5))
+        self.assertEqual(len(leaves), 3)
+        self.assertEqual(leaves[2], ["s2", "s3", "s4"])
+
+        leaves = schema.concat([schema.flatten(nested_batch(0, 2)), leaves])
+        batch = schema.unflatten(leaves)
+        self.assertIsInstance(batch, Sample)
+        self.assertEqual(batch.meta["label"].tolist(), [0, 1, 2, 3, 4])
+
+        for other in [
+            (torch.zeros(2), {"label": torch.zeros(2)}),
+            Sample(torch.zeros(2), {"label": torch.zeros(2)}),
+            Sample(torch.zeros(2), {"label": torch.zeros(2), "source": ["a"]}),
+        ]:
+            with self.assertRaises(ValueError):
+                schema.flatten(other)
+
+    @unittest.skipUnless(torch.cuda.is_available(), "pinning requires CUDA")
+    def test_pin_memory(self):
+        batches = [
+            {"image": torch.zeros(2, 3), "name": ["a", "b"]},
+            {"image": torch.ones(1, 3), "name": ["c"]},
+        ]
+        batch = concat_batches(batches, pin_memory=True)
+        self.assertTrue(batch["image"].is_pinned())
+        self.assertFalse(concat_batches(batches)["image"].is_pinned())
+
+
+if __name__ == "__main__":
+    unittest.main()